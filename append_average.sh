@@ -25,6 +25,10 @@ should be sorted in coordinates beforehand, and can be compressed.
 The output is written to <out-file>, if provided; otherwise to
 standard screen.
 
+The <bedgraph-file> can also be a binary coverage file (*.bcov)
+created by 'bincov.py convert', which is memory-mapped instead of
+parsed; then only bincov.py is needed.
+
 E.g.: $0 in.bed in.bedgraph.gz out.bed
 
 EOF
@@ -36,6 +40,16 @@ if [[ $# -lt 2 ]]; then
 	exit 1;
 fi
 
+if [[ $2 =~ \.bcov$ ]]; then
+	if [[ ! $( command -v bincov.py ) ]]; then
+		msg_warn "Command 'bincov.py' can not be found"
+		exit 4;
+	fi
+	bincov.py average ${3:+-o $3} <(less $1) $2
+	msg_info "Job is done"
+	exit 0;
+fi
+
 depends=(weighted_avg.py bedtools)
 
 for e in "${depends[@]}"
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+import sys;
+import argparse as ap;
+import struct;
+import json;
+import gzip;
+import pandas as pd;
+import numpy as np;
+
+MAGIC=b"BCOV";
+VERSION=1;
+HEADER=struct.Struct("<4sIQ"); # magic, version, offset of the index
+
+# lines at the top of a bedGraph file which are not blocks
+HEADER_PREFIXES=("track", "browser", "#");
+
+# the arrays stored for each chromosome, in this order
+FIELDS=[("starts", np.int32), ("ends", np.int32), ("depths", np.float32),
+		("cum", np.float64), ("cumLen", np.int64)];
+
+# functions
+## count the header lines of a bedGraph file
+def header_lines(infile):
+	'''
+	return the number of track, browser and comment lines at the top
+	of a bedGraph file
+	'''
+	opener=gzip.open if infile.endswith(".gz") else open;
+	n=0;
+	with opener(infile, "rt") as f:
+		for l in f:
+			if not l.startswith(HEADER_PREFIXES):
+				break;
+			n+=1;
+	return(n);
+
+## read a sorted bedGraph file one chromosome at a time
+def read_bedgraph(infile, chunkSize=1000000):
+	'''
+	stream the blocks of a coordinate-sorted bedGraph file and yield
+	(chrom, blocks) for one chromosome at a time, where blocks has the
+	columns start, end, depth in compact dtypes (int32, int32,
+	float32). Only the current chromosome is kept in memory. Track,
+	browser and comment lines at the top are skipped.
+	'''
+	reader=pd.read_csv(infile, sep="\t", header=None, usecols=[0,1,2,3],
+			names=["chr","start","end","depth"],
+			skiprows=header_lines(infile),
+			dtype={"chr": "category", "start": np.int32,
+				"end": np.int32, "depth": np.float32},
+			chunksize=chunkSize);
+	seen=set();
+	chrom=None;
+	parts=[];
+	for chunk in reader:
+		codes=chunk['chr'].cat.codes.to_numpy();
+		breaks=np.flatnonzero(codes[1:]!=codes[:-1])+1;
+		bounds=np.concatenate(([0], breaks, [len(codes)]));
+		for a, b in zip(bounds[:-1], bounds[1:]):
+			name=chunk['chr'].iat[a];
+			if name != chrom:
+				if chrom is not None:
+					yield((chrom, pd.concat(parts, ignore_index=True)));
+				if name in seen:
+					sys.exit(f"chromosome '{name}' appears in multiple blocks. file not sorted");
+				seen.add(name);
+				chrom=name;
+				parts=[];
+			parts.append(chunk.iloc[a:b, 1:]);
+	if chrom is not None:
+		yield((chrom, pd.concat(parts, ignore_index=True)));
+
+## write a bedGraph file into the binary coverage format
+def write_bincov(infile, outfile):
+	'''
+	convert a sorted bedGraph file into the binary coverage format:
+	a header (magic, version, index offset), then for each chromosome
+	the arrays in FIELDS, each aligned to 8 bytes, and finally a JSON
+	index giving the number of blocks and the offset of each array.
+	cum[k] and cumLen[k] are the total depth*length and the total length
+	of the blocks before block k. Returns the number of chromosomes.
+	'''
+	index={};
+	with open(outfile, "wb") as o:
+		o.write(HEADER.pack(MAGIC, VERSION, 0));
+		for chrom, blocks in read_bedgraph(infile):
+			starts=blocks['start'].to_numpy();
+			ends=blocks['end'].to_numpy();
+			depths=blocks['depth'].to_numpy();
+			lens=ends.astype(np.int64)-starts;
+			if (lens < 0).any() or (starts[1:] < ends[:-1]).any():
+				sys.exit(f"blocks on chromosome '{chrom}' are not sorted or overlap");
+			cum=np.zeros(len(starts)+1, dtype=np.float64);
+			np.cumsum(depths*lens, out=cum[1:]);
+			cumLen=np.zeros(len(starts)+1, dtype=np.int64);
+			np.cumsum(lens, out=cumLen[1:]);
+			arrays={"starts": starts, "ends": ends, "depths": depths,
+					"cum": cum, "cumLen": cumLen};
+			entry={"n": len(starts)};
+			for name, dtype in FIELDS:
+				o.write(b"\0"*(-o.tell() % 8));
+				entry[name]=o.tell();
+				o.write(arrays[name].astype(dtype, copy=False).tobytes());
+			index[chrom]=entry;
+		indexOffset=o.tell();
+		o.write(json.dumps(index).encode());
+		o.seek(0);
+		o.write(HEADER.pack(MAGIC, VERSION, indexOffset));
+	return(len(index));
+
+def is_bincov(infile):
+	'''
+	check whether a file is in the binary coverage format
+	'''
+	with open(infile, "rb") as f:
+		return(f.read(len(MAGIC)) == MAGIC);
+
+## open a binary coverage file
+def open_bincov(infile):
+	'''
+	memory-map a binary coverage file and return a dict mapping each
+	chromosome to the tuple of its arrays (starts, ends, depths, cum,
+	cumLen), in the order of the original bedGraph. The arrays are
+	read-only views of the file, so only the pages used are read.
+	'''
+	buf=np.memmap(infile, dtype=np.uint8, mode='r');
+	magic, version, indexOffset=HEADER.unpack_from(buf, 0);
+	if magic != MAGIC:
+		raise ValueError(f"'{infile}' is not a binary coverage file");
+	if version != VERSION:
+		raise ValueError(f"'{infile}' has version {version}, expect {VERSION}");
+	index=json.loads(bytes(buf[indexOffset:]).decode());
+	res={};
+	for chrom, entry in index.items():
+		n=entry["n"];
+		res[chrom]=tuple(np.frombuffer(buf, dtype=dtype,
+				count=n+1 if name.startswith("cum") else n,
+				offset=entry[name]) for name, dtype in FIELDS);
+	return(res);
+
+## get the accumulated depth and covered length at positions
+def prefix_at(cov, pos):
+	'''
+	return the total depth*length and the total covered length from
+	the chromosome start up to each position in the array "pos"
+	'''
+	starts, ends, depths, cum, cumLen = cov;
+	idx=np.searchsorted(starts, pos, side='right')-1; # last block starting <= pos
+	inBlock=np.clip(idx, 0, None);
+	partial=np.clip(pos-starts[inBlock], 0, ends[inBlock]-starts[inBlock]);
+	total=cum[inBlock]+depths[inBlock]*partial;
+	covered=cumLen[inBlock]+partial;
+	total[idx<0]=0;
+	covered[idx<0]=0;
+	return((total, covered));
+
+## average depth of regions
+def region_average(cov, starts, ends, includeGaps=False):
+	'''
+	return the mean depth of the regions [starts, ends), weighted by
+	the overlap lengths with the blocks. By default only the covered
+	bases are counted, the same as append_average.sh; with includeGaps
+	the bases without blocks count as depth 0.
+	'''
+	if cov is None or len(cov[0]) == 0:
+		return(np.zeros(len(starts)));
+	t1, c1=prefix_at(cov, starts);
+	t2, c2=prefix_at(cov, ends);
+	width=ends-starts if includeGaps else c2-c1;
+	return((t2-t1)/np.where(width > 0, width, 1));
+
+def average_bed(bedFile, covFile, o, includeGaps=False, batchSize=1000000):
+	'''
+	append the average depth to each line of a bed file, keeping the
+	line order, processing batchSize lines at a time
+	'''
+	cov=open_bincov(covFile);
+	def flush(lines):
+		fields=[l.split("\t", 3) for l in lines];
+		chroms=np.array([f[0] for f in fields]);
+		starts=np.array([int(f[1]) for f in fields], dtype=np.int64);
+		ends=np.array([int(f[2]) for f in fields], dtype=np.int64);
+		avg=np.zeros(len(lines));
+		for chrom in np.unique(chroms):
+			sel=chroms == chrom;
+			avg[sel]=region_average(cov.get(chrom), starts[sel], ends[sel],
+					includeGaps);
+		o.write("".join("{0}\t{1:.4g}\n".format(l, v)
+			for l, v in zip(lines, avg.tolist())));
+	with open(bedFile, "r") as f:
+		lines=[];
+		for l in f:
+			if l.startswith(HEADER_PREFIXES):
+				continue;
+			lines.append(l.rstrip("\n"));
+			if len(lines) >= batchSize:
+				flush(lines);
+				lines=[];
+		if lines:
+			flush(lines);
+
+desc='''
+This program converts a bedGraph file into a binary coverage format
+that can be memory-mapped, so that repeated analyses of the same
+sample don't need to parse the text again, and computes region
+averages from the binary file.
+
+Subcommands:
+  convert: convert a coordinate-sorted bedGraph file into the binary
+           coverage format (.bcov).
+  average: append the average depth to each region of a bed file, the
+           same as append_average.sh.
+
+The binary file is also accepted by call_peaks.py.
+
+Default values for optional arguments are in [].
+''';
+
+authorInfo='''
+Author: Zhenguo Zhang
+Email: zhangz.sci@gmail.com
+''';
+
+if __name__ == "__main__":
+	op=ap.ArgumentParser(
+			description=desc,
+			formatter_class=ap.RawTextHelpFormatter,
+			epilog=authorInfo);
+	sub=op.add_subparsers(dest="command", required=True);
+
+	conv=sub.add_parser("convert",
+			help="convert a bedGraph file into the binary coverage format");
+	conv.add_argument("infile",
+			help="the input bedGraph file, sorted in coordinates. Track, browser and comment lines at the top are skipped");
+	conv.add_argument("outfile",
+			help="the output binary coverage file, such as sample.bcov");
+
+	avg=sub.add_parser("average",
+			help="append the average depth to each region of a bed file");
+	avg.add_argument("bedFile",
+			help="the bed file with regions, having at least 3 fields");
+	avg.add_argument("covFile",
+			help="the binary coverage file");
+	avg.add_argument("--include-gaps",
+			help="count bases not covered by any block as depth 0; by default only covered bases are averaged",
+			action="store_true",
+			dest="includeGaps");
+	avg.add_argument("--out-file", "-o",
+			help="output filename [stdout]",
+			default=sys.stdout,
+			dest="outFile");
+
+	args=op.parse_args();
+
+	if args.command == "convert":
+		n=write_bincov(args.infile, args.outfile);
+		print(f"[Info] {n} chromosomes written to '{args.outfile}'", file=sys.stderr);
+	else:
+		o=args.outFile;
+		if type(o) is str:
+			o=open(o, "w");
+		average_bed(args.bedFile, args.covFile, o, args.includeGaps);
+		o.close();
+
+	print("Job is done", file=sys.stderr);
+	sys.exit(0);
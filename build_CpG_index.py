@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import argparse as ap
+import numpy as np
+import twobit
+
+SIZES_FILE = "chrom.sizes"
+
+def CpG_positions(genome, chrom, step=10000000):
+    '''
+    return the sorted 0-based positions of all CpGs on a chromosome as
+    a uint32 array, decoding the sequence in blocks of "step" bases
+    '''
+    size = genome.size(chrom)
+    res = []
+    for start in range(0, size, step):
+        end = min(size, start + step + 1) # one more base for a CG across blocks
+        s = genome.codes(chrom, start, end) & 0xDF # uppercase
+        pos = np.flatnonzero((s[:-1] == ord('C')) & (s[1:] == ord('G')))
+        res.append((pos[pos < step] + start).astype(np.uint32))
+    return np.concatenate(res) if res else np.zeros(0, dtype=np.uint32)
+
+def build_index(twobitFile, outDir):
+    '''
+    write the CpG positions of each chromosome into outDir/<chrom>.npy
+    and the chromosome sizes into outDir/chrom.sizes
+    '''
+    genome = twobit.TwoBit(twobitFile)
+    os.makedirs(outDir, exist_ok=True)
+    with open(os.path.join(outDir, SIZES_FILE), "w") as f:
+        for chrom in genome.names():
+            pos = CpG_positions(genome, chrom)
+            np.save(os.path.join(outDir, chrom + ".npy"), pos)
+            print(f"{chrom}\t{genome.size(chrom)}", file=f)
+            print(f"# {chrom}: {len(pos)} CpGs", file=sys.stderr)
+
+if __name__ == "__main__":
+
+    desc='''
+    This program builds the index of CpG positions of a genome from a
+    .2bit file, which is used by the option --cpg-index of
+    get_CpG_pos_in_region.py. The index is a folder with one file of
+    sorted CpG positions (uint32 .npy) per chromosome and the file
+    'chrom.sizes'.
+    '''
+
+    authorInfo='''
+    Author: Zhenguo Zhang
+    Email: zhangz.sci@gmail.com
+    '''
+
+    optParser=ap.ArgumentParser(
+            description=desc,
+            formatter_class=ap.RawTextHelpFormatter,
+            epilog=authorInfo)
+
+    optParser.add_argument("twobitFile",
+            help="the .2bit file of the genome")
+
+    optParser.add_argument("outDir",
+            help="the folder to store the index, such as hg38.cpg")
+
+    args=optParser.parse_args()
+
+    build_index(args.twobitFile, args.outDir)
+
+    print("Job is done", file=sys.stderr)
+
+    sys.exit(0)
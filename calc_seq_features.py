@@ -4,16 +4,90 @@ import sys;
 import argparse as ap;
 import textwrap;
 #import primer3;
-import melting;
+import numpy as np;
+import functools;
+import json;
+import sqlite3;
+import concurrent.futures as cf;
+from collections import deque;
+import gzip;
+import math;
+import twobit;
+
+# the conditions passed to melting.temp
+TM_CONDITIONS = {'DNA_c': 50, 'Na_c': 50, 'Mg_c': 0, 'dNTPs_c': 0.8};
+
+tmCache = None; # the TmCache, if used
+genome = None; # the reference genome in region mode, opened in each process
 
 # define functions
 def calc_Tm(s, digits=3):
 	''' calculate Tm using the method in melting,
 	as the primer3.calcTm produces -999999.9999 for some sequences
 	'''
-	tm = melting.temp(s, DNA_c=50, Na_c=50, Mg_c=0, dNTPs_c=0.8);
+	if tmCache is not None:
+		tm = tmCache.get(s);
+	else:
+		import melting; # only needed by this engine
+		tm = melting.temp(s, **TM_CONDITIONS);
 	return(round(tm,digits));
 
+class TmCache:
+	''' cache of the Tm from melting.temp: an in-memory LRU cache of
+	the given size, backed by an optional SQLite database keyed by the
+	sequence and the conditions, so that sequences seen in previous runs
+	are not computed again. New values are saved in batches.
+	'''
+	def __init__(self, dbFile=None, size=100000, batchSize=10000):
+		self.conditions = json.dumps(TM_CONDITIONS, sort_keys=True);
+		self.db = None;
+		self.new = [];
+		self.batchSize = batchSize;
+		self.diskHits = 0;
+		self.misses = 0;
+		if dbFile is not None:
+			self.db = sqlite3.connect(dbFile, timeout=60); # shared by workers
+			self.db.execute("CREATE TABLE IF NOT EXISTS tm (seq TEXT, "
+				"conditions TEXT, tm REAL, PRIMARY KEY (seq, conditions)) "
+				"WITHOUT ROWID");
+		self.get = functools.lru_cache(maxsize=size)(self.lookup);
+
+	def lookup(self, s):
+		''' get the Tm from the database, or compute it '''
+		if self.db is not None:
+			row = self.db.execute("SELECT tm FROM tm WHERE seq=? AND conditions=?",
+				(s, self.conditions)).fetchone();
+			if row is not None:
+				self.diskHits += 1;
+				return(row[0]);
+		self.misses += 1;
+		import melting;
+		tm = melting.temp(s, **TM_CONDITIONS);
+		if self.db is not None:
+			self.new.append((s, self.conditions, tm));
+			if len(self.new) >= self.batchSize:
+				self.save();
+		return(tm);
+
+	def save(self):
+		if self.new:
+			self.db.executemany("INSERT OR IGNORE INTO tm VALUES (?, ?, ?)", self.new);
+			self.db.commit();
+			self.new = [];
+
+	def close(self):
+		if self.db is not None:
+			self.save();
+			self.db.close();
+
+	def counts(self):
+		''' the numbers of hits in memory, hits on disk and misses '''
+		return((self.get.cache_info().hits, self.diskHits, self.misses));
+
+def report_tm_cache(counts):
+	print("[Info] Tm cache: {} hits in memory, {} hits on disk, {} computed".format(
+		*counts), file=sys.stderr);
+
 def count_CpGs(s):
 	''' count CpGs in a sequence '''
 	n = s.count('CG');
@@ -25,6 +99,481 @@ def calc_GC_content(s):
 	p = int(n/len(s)*100);
 	return(p)
 
+def pack_seqs(seqs):
+	''' pack sequences into one byte array, separated by a newline.
+	Returns the array and the starts and lengths of the sequences.
+	'''
+	lens = np.fromiter((len(x) for x in seqs), dtype=np.int64, count=len(seqs));
+	buf = np.frombuffer("\n".join(seqs).encode('latin-1', 'replace'), dtype=np.uint8);
+	starts = np.zeros(len(seqs), dtype=np.int64);
+	np.cumsum(lens[:-1]+1, out=starts[1:]);
+	return(buf, starts, lens);
+
+# SantaLucia (1998) unified nearest-neighbor parameters, dH in kcal/mol
+# and dS in cal/K/mol, indexed by 5*first+second base with A=0, C=1,
+# G=2, T=3 and 4 for any other character (no contribution)
+NN_CODE = np.full(256, 4, dtype=np.uint8);
+for i, b in enumerate("ACGT"):
+	NN_CODE[ord(b)] = i;
+NN_DH = np.zeros(25);
+NN_DS = np.zeros(25);
+for pair, dh, ds in [("AA", -7.9, -22.2), ("TT", -7.9, -22.2),
+		("AT", -7.2, -20.4), ("TA", -7.2, -21.3),
+		("CA", -8.5, -22.7), ("TG", -8.5, -22.7),
+		("GT", -8.4, -22.4), ("AC", -8.4, -22.4),
+		("CT", -7.8, -21.0), ("AG", -7.8, -21.0),
+		("GA", -8.2, -22.2), ("TC", -8.2, -22.2),
+		("CG", -10.6, -27.2), ("GC", -9.8, -24.4),
+		("GG", -8.0, -19.9), ("CC", -8.0, -19.9)]:
+	k = 5*"ACGT".index(pair[0]) + "ACGT".index(pair[1]);
+	NN_DH[k], NN_DS[k] = dh, ds;
+# initiation with a terminal G/C or A/T pair, for each end
+NN_INIT_DH = np.array([2.3, 0.1, 0.1, 2.3, 0]);
+NN_INIT_DS = np.array([4.1, -2.8, -2.8, 4.1, 0]);
+
+def nn_Tm(seqs, DNA_c=50, Na_c=50, Mg_c=0, dNTPs_c=0.8):
+	''' calculate the Tm of a list of uppercase sequences with the
+	nearest-neighbor model for non-self-complementary duplexes
+	(SantaLucia 1998): the dinucleotide dH and dS are looked up for
+	all sequences at once and summed per sequence, Mg2+ not bound by
+	dNTPs is converted to Na+ equivalents (von Ahsen et al. 2001), and
+	the salt correction is applied to dS. The concentrations are in nM
+	(DNA_c) and mM. Returns an array with nan for empty sequences.
+	'''
+	buf, starts, lens = pack_seqs(seqs);
+	codes = NN_CODE[buf];
+	pairs = np.full(len(buf), 24); # the separators contribute nothing
+	pairs[:-1] = codes[:-1]*5 + codes[1:];
+	ok = lens > 0;
+	dh = np.zeros(len(seqs));
+	ds = np.zeros(len(seqs));
+	if ok.any():
+		dh[ok] = np.add.reduceat(NN_DH[pairs], starts[ok]);
+		ds[ok] = np.add.reduceat(NN_DS[pairs], starts[ok]);
+		for end in (starts[ok], starts[ok] + lens[ok] - 1):
+			dh[ok] += NN_INIT_DH[codes[end]];
+			ds[ok] += NN_INIT_DS[codes[end]];
+	salt = Na_c;
+	if Mg_c > dNTPs_c:
+		salt += 120*np.sqrt(Mg_c - dNTPs_c);
+	ds += 0.368*(lens - 1)*np.log(salt/1000);
+	R = 1.987; # the gas constant, cal/K/mol
+	with np.errstate(divide='ignore', invalid='ignore'):
+		tm = 1000*dh/(ds + R*np.log(DNA_c*1e-9/4)) - 273.15;
+	tm[~ok] = np.nan;
+	return(tm);
+
+def calc_Tm_nn(s, digits=3):
+	''' calculate Tm with the built-in nearest-neighbor model '''
+	return(round(float(nn_Tm([s], **TM_CONDITIONS)[0]), digits));
+
+class SeqBatch:
+	''' a block of uppercase sequences packed into one array and
+	encoded once for all the features: bases as A=0, C=1, G=2, T=3 (4
+	for other characters and the separators), and k-mers as rolling
+	2-bit codes built from the (k-1)-mers. The k-mer codes and the
+	per-sequence k-mer counts are cached, so features derived from them
+	add little time. sep is the field separator of the output, for
+	features returning several columns joined.
+	'''
+	def __init__(self, seqs, sep="\t"):
+		self.seqs = seqs;
+		self.sep = sep;
+		self.buf, self.starts, self.lens = pack_seqs(seqs);
+		self.codes = NN_CODE[self.buf];
+		# the sequence of each position; a separator goes with the one before
+		self.seqIndex = np.repeat(np.arange(len(seqs)), self.lens+1)[:len(self.buf)];
+		self._kmers = {1: (self.codes, self.codes < 4)};
+		self._counts = {};
+
+	def kmers(self, k):
+		''' return the codes of the k-mers starting at each position and
+		whether each k-mer is made of ACGT within one sequence
+		'''
+		if k not in self._kmers:
+			prev, valid = self.kmers(k-1);
+			n = len(self.codes) - k + 1;
+			code = np.zeros(len(self.codes), dtype=np.int32);
+			ok = np.zeros(len(self.codes), dtype=bool);
+			if n > 0:
+				last = self.codes[k-1:];
+				code[:n] = prev[:n]*4 + last;
+				ok[:n] = valid[:n] & (last < 4);
+			self._kmers[k] = (code, ok);
+		return(self._kmers[k]);
+
+	def counts(self, k, a=0, b=None):
+		''' return the counts of the 4^k k-mers in the sequences a to b
+		(all by default) as an int32 matrix of one row per sequence,
+		k-mers in the order of kmer_names(). The counts of all the
+		sequences are cached.
+		'''
+		n = len(self.seqs);
+		b = n if b is None else b;
+		full = a == 0 and b == n;
+		if full and k in self._counts:
+			return(self._counts[k]);
+		code, ok = self.kmers(k);
+		p0, p1 = [self.starts[x] if x < n else len(self.buf) for x in (a, b)];
+		sel = ok[p0:p1];
+		idx = (self.seqIndex[p0:p1][sel] - a)*4**k + code[p0:p1][sel];
+		res = np.bincount(idx, minlength=(b-a)*4**k).astype(np.int32).reshape(
+			b-a, 4**k);
+		if full:
+			self._counts[k] = res;
+		return(res);
+
+def kmer_names(k):
+	''' all k-mers in the order of their codes '''
+	names = [''];
+	for i in range(k):
+		names = [x + b for x in names for b in "ACGT"];
+	return(names);
+
+def format_values(x, ok, fmt="{:.4g}"):
+	''' format an array of values as strings, NA where not ok. Each
+	distinct value is formatted only once.
+	'''
+	values, idx = np.unique(x, return_inverse=True);
+	strs = np.array([fmt.format(v) for v in values.tolist()] + ['NA'], dtype=object);
+	idx[~ok] = len(values);
+	return(strs[idx].tolist());
+
+# the features computed with --batch: name => (function of a SeqBatch
+# returning a list of columns as lists of strings, column names). A
+# column may also hold the values of several columns of a row joined
+# by batch.sep, so that wide features don't make a string per value.
+FEATURES = {};
+
+KMER_BLOCK_CELLS = 1 << 22; # the counts made at once by kmer features
+MAX_CHUNK_CELLS = 1 << 24; # the output values of a chunk of sequences
+
+def register_feature(name, columns=None):
+	''' a decorator to register a batch feature '''
+	def wrap(func):
+		FEATURES[name] = (func, columns or [name]);
+		return(func);
+	return(wrap);
+
+@register_feature('Tm')
+def batch_Tm(batch):
+	if featureFuncs['Tm'] is calc_Tm_nn:
+		tm = nn_Tm(batch.seqs, **TM_CONDITIONS);
+		return([[str(round(x, 3)) if l > 0 else 'NA' for x, l in
+			zip(tm.tolist(), batch.lens.tolist())]]);
+	return([[str(featureFuncs['Tm'](x)) for x in batch.seqs]]);
+
+@register_feature('nCpG')
+def batch_nCpG(batch):
+	n = batch.counts(2)[:, 6]; # CG
+	return([list(map(str, n.tolist()))]);
+
+@register_feature('GC')
+def batch_GC(batch):
+	n = batch.counts(1)[:, 1] + batch.counts(1)[:, 2];
+	lens = batch.lens;
+	with np.errstate(divide='ignore', invalid='ignore'):
+		p = n/lens*100; # the same operations as calc_GC_content
+	p = np.where(lens > 0, p, 0).astype(np.int64); # truncated as int()
+	return([format_values(p, lens > 0, "{}")]);
+
+@register_feature('dinuc', ['f_' + x for x in kmer_names(2)])
+def batch_dinuc(batch):
+	c = batch.counts(2);
+	total = c.sum(axis=1);
+	f = c / np.maximum(total, 1)[:, None];
+	return([format_values(f[:, i], total > 0) for i in range(16)]);
+
+def kmer_feature(k):
+	''' the k-mer counts of each sequence, as one joined column counted
+	and formatted for blocks of sequences, so that the memory is
+	bounded for large k
+	'''
+	def func(batch):
+		n = len(batch.seqs);
+		step = max(1, KMER_BLOCK_CELLS // 4**k);
+		rows = [];
+		for a in range(0, n, step):
+			c = batch.counts(k, a, min(n, a + step));
+			strs = np.array([str(x) for x in range(int(c.max()) + 1)], dtype=object);
+			rows.extend(map(batch.sep.join, strs[c].tolist()));
+		return([rows]);
+	return(func);
+
+for k in range(1, 7):
+	register_feature('kmer{}'.format(k), kmer_names(k))(kmer_feature(k));
+
+@register_feature('entropy')
+def batch_entropy(batch):
+	c = batch.counts(1);
+	total = c.sum(axis=1);
+	p = c / np.maximum(total, 1)[:, None];
+	with np.errstate(divide='ignore', invalid='ignore'):
+		h = -np.where(p > 0, p*np.log2(p), 0).sum(axis=1);
+	return([format_values(h, total > 0)]);
+
+@register_feature('homopolymer')
+def batch_homopolymer(batch):
+	''' the longest run of one base in each sequence '''
+	codes = batch.codes;
+	res = np.zeros(len(batch.seqs), dtype=np.int64);
+	if len(codes) > 0:
+		change = np.ones(len(codes), dtype=bool);
+		change[1:] = codes[1:] != codes[:-1];
+		runStarts = np.flatnonzero(change);
+		runLens = np.diff(np.append(runStarts, len(codes)));
+		keep = codes[runStarts] < 4; # separators break runs
+		np.maximum.at(res, batch.seqIndex[runStarts[keep]], runLens[keep]);
+	return([list(map(str, res.tolist()))]);
+
+@register_feature('CpG_oe')
+def batch_CpG_oe(batch):
+	''' observed/expected CpGs: nCpG*length/(nC*nG) '''
+	c = batch.counts(1).astype(np.int64);
+	expect = c[:, 1]*c[:, 2];
+	oe = batch.counts(2)[:, 6]*batch.lens / np.maximum(expect, 1);
+	return([format_values(oe, expect > 0)]);
+
+def feature_columns(features):
+	''' the output column names of the features '''
+	return([x for feat in features for x in FEATURES[feat][1]]);
+
+def batch_features(seqs, features, sep="\t"):
+	''' compute the features of a block of uppercase sequences at once
+	from one SeqBatch. Returns the columns seqLen and the features as
+	lists of strings; the values are the same as the functions above,
+	and GC is NA for empty sequences.
+	'''
+	batch = SeqBatch(seqs, sep);
+	cols = [list(map(str, batch.lens.tolist()))];
+	for feat in features:
+		cols.extend(FEATURES[feat][0](batch));
+	return(cols);
+
+def seq_features(lines, firstId):
+	''' compute the features of the sequences in the input lines and
+	return the output rows as one string, numbered from firstId
+	'''
+	if args.genome is not None:
+		return(region_features(lines));
+	seqs = [r.strip().split(args.sep)[args.seqCol].upper() for r in lines];
+	if args.batch:
+		cols = batch_features(seqs, features, args.sep);
+	else:
+		cols = [[str(len(x)) for x in seqs]] + [[str(func(x)) for x in seqs]
+			for func in funcs];
+	ids = map(str, range(firstId, firstId+len(seqs)));
+	return("".join(args.sep.join(x)+"\n" for x in zip(ids, *cols)));
+
+class FastaIndex:
+	''' a reader of fasta files indexed by 'samtools faidx', with the
+	same size() and codes() methods as twobit.TwoBit. The file is
+	memory-mapped, and only the lines of a region are read.
+	'''
+	def __init__(self, path):
+		self.buf = np.memmap(path, dtype=np.uint8, mode='r');
+		self.index = {};
+		with open(path + ".fai", "r") as f:
+			for l in f:
+				name, size, offset, lineBases, lineWidth = l.split("\t")[:5];
+				self.index[name] = (int(size), int(offset), int(lineBases), int(lineWidth));
+
+	def size(self, chrom):
+		return(self.index[chrom][0] if chrom in self.index else None);
+
+	def codes(self, chrom, start, end):
+		''' return the ASCII codes of the sequence [start, end), or None
+		if the sequence is not in the file or the region is out of range
+		'''
+		if chrom not in self.index:
+			return(None);
+		size, offset, lineBases, lineWidth = self.index[chrom];
+		if start < 0 or end > size or start > end:
+			return(None);
+		pos = lambda x: offset + x//lineBases*lineWidth + x%lineBases;
+		raw = self.buf[pos(start):pos(end)];
+		return(raw[(raw != ord("\n")) & (raw != ord("\r"))]);
+
+def open_genome(path):
+	''' open a .2bit file or a fasta file indexed with a .fai file '''
+	if path.endswith(".2bit"):
+		return(twobit.TwoBit(path));
+	return(FastaIndex(path));
+
+def fetch_regions(regions):
+	''' get the sequences of the regions (chrom, start, end), in
+	coordinate order per chromosome: overlapping regions are merged,
+	and each merged span is read once. Returns the uppercase sequences,
+	with None for regions not in the genome.
+	'''
+	global genome;
+	if genome is None:
+		genome = open_genome(args.genome);
+	seqs = [None]*len(regions);
+	byChrom = {};
+	for i, r in enumerate(regions):
+		byChrom.setdefault(r[0], []).append(i);
+	for chrom, idx in byChrom.items():
+		size = genome.size(chrom);
+		if size is None:
+			continue;
+		idx = sorted((i for i in idx if 0 <= regions[i][1] <= regions[i][2] <= size),
+			key=lambda i: regions[i][1]);
+		a = 0;
+		while a < len(idx):
+			spanStart = regions[idx[a]][1];
+			spanEnd = regions[idx[a]][2];
+			b = a + 1;
+			while b < len(idx) and regions[idx[b]][1] <= spanEnd:
+				spanEnd = max(spanEnd, regions[idx[b]][2]);
+				b += 1;
+			span = genome.codes(chrom, spanStart, spanEnd).tobytes().decode('latin-1').upper();
+			for i in idx[a:b]:
+				seqs[i] = span[regions[i][1]-spanStart:regions[i][2]-spanStart];
+			a = b;
+	return(seqs);
+
+def region_features(lines):
+	''' compute the features of the regions in the bed lines and return
+	the rows of the bed fields and the features as one string
+	'''
+	fields = [l.rstrip("\r\n").split("\t") for l in lines
+		if not l.startswith(("#", "track", "browser")) and l.strip()];
+	seqs = fetch_regions([(x[0], int(x[1]), int(x[2])) for x in fields]);
+	for x, seq in zip(fields, seqs):
+		if seq is None:
+			print("[Warning] Cannot get sequence for [{}]".format("\t".join(x)),
+				file=sys.stderr);
+	fields = [x for x, seq in zip(fields, seqs) if seq is not None];
+	cols = batch_features([seq for seq in seqs if seq is not None], features);
+	return("".join("\t".join(x + list(y))+"\n" for x, y in zip(fields, zip(*cols))));
+
+def bed_header(infile):
+	''' the column names of a bed file, from its first region '''
+	names = ['#chrom', 'start', 'end', 'name', 'score', 'strand'];
+	with open(infile, "r") as f:
+		for l in f:
+			if not l.startswith(("#", "track", "browser")) and l.strip():
+				n = len(l.rstrip("\r\n").split("\t"));
+				return(names[:n] + ["col{}".format(i+1) for i in range(len(names), n)]);
+	return(names[:3]);
+
+def read_chunks(f, chunkSize):
+	''' yield (the id of the first line, lines) for chunks of the input '''
+	lines = [];
+	id = 1;
+	for r in f:
+		lines.append(r);
+		if len(lines) >= chunkSize:
+			yield((id, lines));
+			id += len(lines);
+			lines = [];
+	if lines:
+		yield((id, lines));
+
+def feature_funcs(tmEngine):
+	''' the functions of the default features, by name '''
+	return({
+		'Tm'   : calc_Tm_nn if tmEngine == 'nn' else calc_Tm,
+		'nCpG' : count_CpGs,
+		'GC'   : calc_GC_content
+		});
+
+def init_worker(options, featureList, useTmCache):
+	''' set the options and features in each worker process, and open
+	a Tm cache of its own
+	'''
+	global args, features, featureFuncs, funcs, tmCache;
+	args = options;
+	features = featureList;
+	featureFuncs = feature_funcs(args.tmEngine);
+	funcs = [featureFuncs[x] for x in features if x in featureFuncs];
+	if useTmCache:
+		tmCache = TmCache(args.tmCache, args.tmCacheSize);
+
+def process_chunk(chunk):
+	''' compute a chunk from read_chunks() in a worker process and
+	return the output rows and the Tm cache counts of this chunk
+	'''
+	before = tmCache.counts() if tmCache is not None else (0, 0, 0);
+	text = seq_features(chunk[1], chunk[0]);
+	if tmCache is None:
+		return((text, (0, 0, 0)));
+	tmCache.save();
+	return((text, tuple(b-a for a, b in zip(before, tmCache.counts()))));
+
+def read_genome(infile):
+	''' yield (name, ASCII codes as a uint8 array) for each sequence of
+	a genome in .2bit or fasta format; fasta may be gzipped
+	'''
+	if infile.endswith(".2bit"):
+		genome = twobit.TwoBit(infile);
+		for chrom in genome.names():
+			yield((chrom, genome.codes(chrom, 0, genome.size(chrom))));
+		return;
+	fh = gzip.open(infile, "rt") if infile.endswith(".gz") else open(infile, "r");
+	name = None;
+	lines = [];
+	for l in fh:
+		if l.startswith(">"):
+			if name is not None:
+				yield((name, np.frombuffer("".join(lines).encode('latin-1', 'replace'), dtype=np.uint8)));
+			name = l[1:].split()[0];
+			lines = [];
+		else:
+			lines.append(l.strip());
+	if name is not None:
+		yield((name, np.frombuffer("".join(lines).encode('latin-1', 'replace'), dtype=np.uint8)));
+	fh.close();
+
+def window_tracks(codes, window, step):
+	''' compute the GC percent and the number of CpGs of the windows
+	[start, start+window) for every step along a sequence, with the last
+	windows cut at the sequence end, as bedtools makewindows. The counts
+	of C/G bases and CpGs are summed in blocks of gcd(window, step)
+	bases, and the prefix sums of the blocks give each window in O(1).
+	Returns arrays of starts, ends, GC percent (as calc_GC_content) and
+	nCpG (as count_CpGs).
+	'''
+	size = len(codes);
+	u = codes & 0xDF; # uppercase
+	isC = u == ord('C');
+	isG = u == ord('G');
+	isCG = np.zeros(size, dtype=bool); # a CpG starting at each base
+	np.logical_and(isC[:-1], isG[1:], out=isCG[:-1]);
+	g = math.gcd(window, step);
+	blocks = np.arange(0, size, g);
+	def prefix(x):
+		cum = np.zeros(len(blocks)+1, dtype=np.int64);
+		if size > 0:
+			np.cumsum(np.add.reduceat(x, blocks, dtype=np.int64), out=cum[1:]);
+		return(cum);
+	gcCum = prefix(isC | isG);
+	cgCum = prefix(isCG);
+	starts = np.arange(0, size, step, dtype=np.int64);
+	ends = np.minimum(starts + window, size);
+	i0 = starts // g;
+	i1 = np.where(ends == size, len(blocks), ends // g);
+	nGC = gcCum[i1] - gcCum[i0];
+	nCpG = cgCum[i1] - cgCum[i0] - isCG[ends - 1]; # not the CpG across the end
+	p = (nGC/(ends - starts)*100).astype(np.int64); # the same as calc_GC_content
+	return((starts, ends, p, nCpG));
+
+def write_tracks(infile, outPrefix, window, step, features):
+	''' write the bedGraph tracks of the features ('GC' and/or 'nCpG')
+	of a genome into outPrefix.<feature>.bedGraph
+	'''
+	outs = {feat: open("{}.{}.bedGraph".format(outPrefix, feat), "w") for feat in features};
+	for chrom, codes in read_genome(infile):
+		starts, ends, p, nCpG = window_tracks(codes, window, step);
+		values = {'GC': p, 'nCpG': nCpG};
+		for feat, out in outs.items():
+			out.write("".join("{}\t{}\t{}\t{}\n".format(chrom, *x) for x in
+				zip(starts.tolist(), ends.tolist(), values[feat].tolist())));
+		print("[Info] {}: {} windows".format(chrom, len(starts)), file=sys.stderr);
+	for out in outs.values():
+		out.close();
+
 desc = textwrap.dedent("""
 	This program calculates the following features for each
 	sequence (unless turned off by options):
@@ -32,6 +581,12 @@ desc = textwrap.dedent("""
 	Tm:    melting temperature
 	nCpG:  number of CpGs
 	GC:    the percentage of GC content
+
+	With --track, the input is a genome in fasta or .2bit format,
+	and the GC and nCpG of sliding windows along each sequence are
+	written as bedGraph tracks. With --genome, the input is a bed
+	file, and the features of the region sequences are added to
+	the bed fields.
 	""");
 
 authorInfo = '''
@@ -39,88 +594,201 @@ Author: Zhenguo Zhang
 Email: zhangz.sci@gmail.com
 ''';
 
-# set up arguments
-optParser = ap.ArgumentParser(
-		description=desc, 
-		formatter_class=ap.RawTextHelpFormatter,
-		#formatter_class=ap.ArgumentDefaultsHelpFormatter,
-		epilog=authorInfo
-		);
-## positional required arguments
-optParser.add_argument("infile",
-	help="input file with sequences");
-
-## optional auxillary arguments
-optParser.add_argument("--column", "-c",
-	help="which column contains sequences,\n default is first column, i.e., 0",
-	type=int,
-	metavar="column",
-	dest="seqCol", # the attribute name to store value
-	default=0,
-	action='store',
-	required = False # just for showcase purpose
-	);
-optParser.add_argument("--outfile", "-o",
-		help="output filename",
-		dest="outFile", # for demonstration only
-		default=sys.stdout,
-		metavar="stdout")
-optParser.add_argument("--sep", "-s",
-		help="field separator of input file",
-		metavar="field-sep",
-		default="\t"
+if __name__ == "__main__":
+	# set up arguments
+	optParser = ap.ArgumentParser(
+			description=desc, 
+			formatter_class=ap.RawTextHelpFormatter,
+			#formatter_class=ap.ArgumentDefaultsHelpFormatter,
+			epilog=authorInfo
+			);
+	## positional required arguments
+	optParser.add_argument("infile",
+		help="input file with sequences");
+
+	## optional auxillary arguments
+	optParser.add_argument("--column", "-c",
+		help="which column contains sequences,\n default is first column, i.e., 0",
+		type=int,
+		metavar="column",
+		dest="seqCol", # the attribute name to store value
+		default=0,
+		action='store',
+		required = False # just for showcase purpose
 		);
-optParser.add_argument("--no-tm", "-nt",
-		help="don't compute Tm",
-		action="store_true") # default is false
-optParser.add_argument("--no-ncpg", "-nn",
-		help="don't compute nCpG",
-		action="store_true") # default is false
-optParser.add_argument("--no-gc", "-ng",
-		help="don't compute GC content",
-		action="store_true") # default is false
-
-args = optParser.parse_args();
-
-#print(args);
-
-# start the analyses
-o=open(args.outFile, "w")
-f=open(args.infile, "r")
-## determine what features to calculate
-featureFuncs = {
-		'Tm'   : calc_Tm,
-		'nCpG' : count_CpGs,
-		'GC'   : calc_GC_content
+	optParser.add_argument("--outfile", "-o",
+			help="output filename",
+			dest="outFile", # for demonstration only
+			default=sys.stdout,
+			metavar="stdout")
+	optParser.add_argument("--sep", "-s",
+			help="field separator of input file",
+			metavar="field-sep",
+			default="\t"
+			);
+	optParser.add_argument("--no-tm", "-nt",
+			help="don't compute Tm",
+			action="store_true") # default is false
+	optParser.add_argument("--no-ncpg", "-nn",
+			help="don't compute nCpG",
+			action="store_true") # default is false
+	optParser.add_argument("--no-gc", "-ng",
+			help="don't compute GC content",
+			action="store_true") # default is false
+	optParser.add_argument("--features",
+			help="comma-separated features to add, computed with --batch\n(implied): dinuc (dinucleotide frequencies), kmer1 to\nkmer6 (k-mer counts), entropy (Shannon entropy of bases\nin bits), homopolymer (the longest run of one base) and\nCpG_oe (observed/expected CpGs)",
+			default=None)
+	optParser.add_argument("--genome",
+			help="a reference genome (.2bit, or fasta indexed by samtools\nfaidx); the input is then a bed file, and the features\nof each region are added to its fields (implies --batch)",
+			default=None)
+	optParser.add_argument("--track",
+			help="the input is a genome (.2bit, or fasta which can be\ngzipped); write the GC and nCpG of sliding windows into\n<outfile>.GC.bedGraph and <outfile>.nCpG.bedGraph",
+			action="store_true") # default is false
+	optParser.add_argument("--window",
+			help="the window size with --track [%(default)d]",
+			type=int,
+			default=200)
+	optParser.add_argument("--step",
+			help="the distance between window starts with --track\n[the window size]",
+			type=int,
+			default=None)
+	optParser.add_argument("--tm-engine",
+			help="how to compute Tm: 'melting' uses melting.temp; 'nn' uses\nthe built-in vectorized nearest-neighbor model (SantaLucia\n1998), which doesn't need melting; its values may\ndiffer slightly from melting's [%(default)s]",
+			choices=['melting', 'nn'],
+			dest="tmEngine",
+			default='melting')
+	optParser.add_argument("--tm-cache",
+			help="a SQLite file to store the Tm of sequences across runs;\ncreated if not existing",
+			dest="tmCache",
+			default=None)
+	optParser.add_argument("--tm-cache-size",
+			help="the number of Tm values kept in memory, 0 for none\n[%(default)d]",
+			type=int,
+			dest="tmCacheSize",
+			default=100000)
+	optParser.add_argument("--batch",
+			help="read sequences in blocks and compute nCpG, GC and\nlength for a whole block at once with numpy",
+			action="store_true") # default is false
+	optParser.add_argument("--cpus",
+			help="the number of processes to compute chunks of sequences\nin parallel; the output is in the input order [%(default)d]",
+			type=int,
+			default=1)
+	optParser.add_argument("--chunk-size",
+			help="the number of sequences in each block with --batch or\n--cpus; reduced for wide --features such as kmer6\n[%(default)d]",
+			type=int,
+			dest="chunkSize",
+			default=100000)
+
+	args = optParser.parse_args();
+
+	#print(args);
+
+	if args.features:
+		for feat in args.features.split(","):
+			if feat not in FEATURES or feat in ('Tm', 'nCpG', 'GC'):
+				optParser.error("Unknown feature '{}' in --features".format(feat));
+
+	# start the analyses
+	if args.track:
+		if type(args.outFile) is not str:
+			optParser.error("--track needs the output prefix by --outfile");
+		if args.window < 1 or (args.step is not None and args.step < 1):
+			optParser.error("--window and --step must be positive");
+		trackFeatures = [x for x in ['GC', 'nCpG'] if not getattr(args, 'no_' + x.lower())];
+		write_tracks(args.infile, args.outFile, args.window,
+			args.step or args.window, trackFeatures);
+		print("Job is done", file=sys.stderr);
+		sys.exit(0);
+
+	if args.tmEngine == 'melting' and not args.no_tm:
+		try:
+			import melting;
+		except ImportError:
+			optParser.error("melting is not installed; use --tm-engine nn or --no-tm");
+
+	useTmCache = args.tmEngine == 'melting' and not args.no_tm and (
+			args.tmCache is not None or args.tmCacheSize > 0);
+	if useTmCache and args.cpus <= 1: # otherwise opened in each worker
+		tmCache = TmCache(args.tmCache, args.tmCacheSize);
+	o=args.outFile;
+	if type(o) is str:
+		o=open(o, "w");
+	f=open(args.infile, "r")
+	## determine what features to calculate
+	featureFuncs = feature_funcs(args.tmEngine);
+	features = [x for x in featureFuncs if not getattr(args, 'no_' + x.lower())];
+	funcs = [featureFuncs[x] for x in features];
+	if args.features:
+		args.batch = True;
+		features.extend(args.features.split(","));
 
+	if args.genome is not None:
+		args.batch = True;
+		o.write("\t".join(bed_header(args.infile) + ['seqLen'] + feature_columns(features))+'\n');
+	else:
+		o.write(args.sep.join(["id",'seqLen'] + feature_columns(features))+'\n');
+	# wide features such as kmer6 make long rows; keep the text of a chunk bounded
+	maxRows = max(1000, MAX_CHUNK_CELLS // len(feature_columns(features) or [0]));
+	if args.chunkSize > maxRows:
+		print("[Info] --chunk-size is reduced to {} for {} output columns".format(
+			maxRows, len(feature_columns(features))), file=sys.stderr);
+		args.chunkSize = maxRows;
+	id=0;
+	if args.cpus > 1:
+		# at most cpus*2 chunks in flight, written in the input order
+		tmCounts = [0, 0, 0];
+		def collect(n, res):
+			global id;
+			text, counts = res;
+			o.write(text);
+			for i, x in enumerate(counts):
+				tmCounts[i] += x;
+			id += n;
+			print("[Info] {} sequences have been processed".format(id),
+				file=sys.stderr);
+		# the workers get the options and features through init_worker(),
+		# without the output file, which can't be pickled
+		options = ap.Namespace(**{k: v for k, v in vars(args).items() if k != 'outFile'});
+		with cf.ProcessPoolExecutor(max_workers=args.cpus, initializer=init_worker,
+				initargs=(options, features, useTmCache)) as executor:
+			pending = deque();
+			for c in read_chunks(f, args.chunkSize):
+				pending.append((len(c[1]), executor.submit(process_chunk, c)));
+				if len(pending) < args.cpus*2:
+					continue;
+				n, future = pending.popleft();
+				collect(n, future.result());
+			while pending:
+				n, future = pending.popleft();
+				collect(n, future.result());
+		if useTmCache:
+			report_tm_cache(tmCounts);
+	elif args.batch:
+		for firstId, lines in read_chunks(f, args.chunkSize):
+			o.write(seq_features(lines, firstId));
+			id += len(lines);
+			print("[Info] {} sequences have been processed".format(id),
+				file=sys.stderr);
+	else:
+		for r in f:
+			r = r.strip().split(args.sep);
+			seq = r[args.seqCol].upper(); # uppercase sequences
+		#	print(seq);
+			id += 1;
+			res=[str(id), str(len(seq))];
+			for func in funcs:
+				res.append(str(func(seq)));
+			#r.extend(res); # combine original line and results
+			#print(args.sep.join(res))
+			o.write(args.sep.join(res)+"\n");
+			if id % 10000 == 0:
+				print("[Info] {} sequences have been processed",
+					id, file=sys.stderr)
 
-		};
-features=[];
-funcs=[];
-for feat, func in featureFuncs.items():
-	if getattr(args, 'no_' + feat.lower()):
-		continue
-	features.append(feat);
-	funcs.append(func);
-
-o.write(args.sep.join(["id",'seqLen'] + features)+'\n');
-id=0;
-for r in f:
-	r = r.strip().split(args.sep);
-	seq = r[args.seqCol].upper(); # uppercase sequences
-#	print(seq);
-	id += 1;
-	res=[str(id), str(len(seq))];
-	for func in funcs:
-		res.append(str(func(seq)));
-	#r.extend(res); # combine original line and results
-	#print(args.sep.join(res))
-	o.write(args.sep.join(res)+"\n");
-	if id % 10000 == 0:
-		print("[Info] {} sequences have been processed",
-			id, file=sys.stderr)
-
-f.close();
-o.close();
-print("Job is done", file=sys.stderr);
-sys.exit(0);
+	f.close();
+	o.close();
+	if tmCache is not None:
+		tmCache.close();
+		report_tm_cache(tmCache.counts());
+	print("Job is done", file=sys.stderr);
+	sys.exit(0);
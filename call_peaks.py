@@ -5,14 +5,21 @@ import os;
 import argparse as ap;
 import textwrap;
 import pandas as pd;
+import numpy as np;
 import random as rd;
-import bisect as bs;
+import concurrent.futures as cf;
+import hashlib;
+import json;
+from collections import deque;
+import bincov;
+
+BG_CACHE_VERSION=2; # change when the background sampling changes
 
 # define functions
 ## build the map of divided regions along chromosomes
-def define_regions(chrSize, trim5=0, trim3=0):
+def define_regions(chrSize, wS, trim5=0, trim3=0):
 	''' return a data frame containing the starting coordinates,
-	number of regions on each chromosome
+	number of regions of size wS on each chromosome
 	'''
 	res=chrSize.apply(lambda x: [x[0],trim5,int((x[1]-trim5-trim3)/wS)], 
 			axis=1,	result_type="expand");
@@ -20,90 +27,397 @@ def define_regions(chrSize, trim5=0, trim3=0):
 			inplace=True)
 	return(res)
 
-## get chromosome coordinates for a given region number
-def region_coord(regions, number):
+## get chromosome coordinates for given region numbers
+def region_coords(regions, numbers, wS):
 	'''
-	give a region number, chromosome coordinates for the region are
+	give an array of region numbers, the row indexes in "regions" of
+	the regions' chromosomes and the region start coordinates are
 	returned. Note the row order of the input data.frame "regions"
 	matters for locating the region.
-	The returned coordinates are 0-based and right open, like UCSC
-	'''
-	regionBounds=regions['counts'].cumsum().tolist();
-	chrIndex=bs.bisect_left(regionBounds, number);
-	chrInfo=regions.iloc[chrIndex,].tolist();
-	preRegions=0; # the number of regions before this index
-	if chrIndex > 0:
-		preRegions=regionBounds[chrIndex-1];
-	# now calculate chr start/end
-	end=(number - preRegions)*wS + chrInfo[1];
-	start=end-wS;
-	return([chrInfo[0], start, end]);
-
-def region_overlap(r1, r2):
-	'''
-	Get the overlap between two regions, in the format of 
-	[chr, start, end, others]. The 'others' columns will be simply
-	copied to results.
-	'''
-	if r1[0] != r2[0]:
-		res=["",-1,-1,0];
-	else:
-		start=max(r1[1],r2[1]);
-		end  =min(r1[2],r2[2]);
-		overlap =end-start;
-		if overlap < 0: # no overlap
-			overlap=0;
-			start=end=-1;
-		res=[r1[0],start,end,overlap];
-	res.extend(r1); # append the original records
-	res.extend(r2);
+	The coordinates are 0-based and right open, like UCSC, and
+	each region ends at start+wS.
+	'''
+	regionBounds=regions['counts'].cumsum().to_numpy();
+	chrIndex=np.searchsorted(regionBounds, numbers, side='left');
+	preRegions=np.concatenate(([0], regionBounds))[chrIndex]; # the number of regions before this index
+	starts=(numbers-preRegions-1)*wS + regions['start'].to_numpy()[chrIndex];
+	return((chrIndex, starts));
+
+## build prefix-sum coverage arrays for the blocks on one chromosome
+def chrom_coverage(blocks):
+	'''
+	convert the bedGraph blocks of one chromosome into numpy arrays
+	(starts, ends, depths, cumulative depth), where the cumulative
+	depth at index k is the total depth*length of the blocks before
+	block k. Blocks must be sorted and non-overlapping.
+	'''
+	starts=blocks['start'].to_numpy(dtype=np.int64);
+	ends=blocks['end'].to_numpy(dtype=np.int64);
+	depths=blocks['depth'].to_numpy(dtype=np.float64);
+	cum=np.zeros(len(starts)+1, dtype=np.float64);
+	np.cumsum(depths*(ends-starts), out=cum[1:]);
+	return((starts, ends, depths, cum));
+
+def cum_depth(cov, pos):
+	'''
+	return the total depth*length accumulated from the chromosome
+	start up to each position in the array "pos"
+	'''
+	starts, ends, depths, cum = cov;
+	idx=np.searchsorted(starts, pos, side='right')-1; # last block starting <= pos
+	inBlock=np.clip(idx, 0, None);
+	partial=np.clip(pos-starts[inBlock], 0, ends[inBlock]-starts[inBlock]);
+	res=cum[inBlock]+depths[inBlock]*partial;
+	res[idx<0]=cum[0]; # positions before the first block
 	return(res);
 
-## get the blocks overlapped with a given region
-def find_overlap_blocks(blocks, region,avg=False):
+def window_depths(cov, start, counts, wS):
 	'''
-	the "region" contains the coordinate, and blocks overlapped with
-	the region are returned.
+	return the mean depth of "counts" consecutive windows of size wS
+	starting at "start"
+	'''
+	bounds=start+np.arange(counts+1, dtype=np.int64)*wS;
+	if len(cov[0]) == 0:
+		return(np.zeros(counts));
+	return(np.diff(cum_depth(cov, bounds))/wS);
+
+def region_depths(cov, starts, wS):
+	'''
+	return the mean depth of the windows of size wS starting at the
+	positions in the array "starts"
+	'''
+	if len(cov[0]) == 0:
+		return(np.zeros(len(starts)));
+	return((cum_depth(cov, starts+wS)-cum_depth(cov, starts))/wS);
+
+## get p values for depth values
+def p_for_depth(bgDepths, depths):
+	'''
+	Given an array of depth values, the fraction of values in bgDepths
+	which are greater than or equal to each depth is returned. bgDepths
+	has been sorted, so that all the values can be located with one
+	searchsorted call. Depths above all background values get 1/size.
 	'''
-	subBlocks=blocks[blocks['chr']==region[0]]; # blocks on the chromosome only
-	if subBlocks.empty:
-		return(None);
-	startIndex=bs.bisect_left(subBlocks['start'].tolist(), region[1]); # first start >= region start
-	endIndex=bs.bisect_left(subBlocks['end'].tolist(), region[2]); # ends
-	endIndex+=1;
-	if startIndex > 0:
-		startIndex-=1; # ensure all overlap blocks are included
-	# get the overlapped regions
-	overlappedBlocks=subBlocks.iloc[startIndex:endIndex,].apply(
-			region_overlap, axis=1, result_type="expand",r2=region);
-	if avg: # return the average density
-		depths=overlappedBlocks.iloc[:,3]*overlappedBlocks.iloc[:,7];
-		avg=depths.sum()/(region[2]-region[1]); # python 3 assumed
-		return(avg)
-	else: # return the blocks
-		return(overlappedBlocks)
-	
-## get p value for a depth value
-def p_for_depth(bgDepths, depth):
-	'''
-	Given a depth value, the fraction of values in bgDepths which are
-	greater than depth is returned. bgDpeth has been sorted, so that
-	we can use bisect algorithm
-	'''
-	if depth==None: return(None);
-	index=bs.bisect_left(bgDepths,depth);
 	size=len(bgDepths);
+	index=np.searchsorted(bgDepths, depths, side='left');
 	p=(size-index)/size; # upside fraction
-	if size == index: p = 1/size;
+	p[index == size]=1/size;
+	return(p);
+
+## fit a background model to the trimmed background depths
+def fit_background(bgDepths, method):
+	'''
+	return the background model (method, params) for p_values(). For
+	'empirical', params is the sorted array bgDepths itself; for
+	'poisson', it is (mean,); for 'negbinom', it is (size, prob) from
+	the method of moments, falling back to poisson when the depths are
+	not overdispersed.
+	'''
+	if method == 'empirical':
+		return((method, bgDepths));
+	mean=bgDepths.mean();
+	var=bgDepths.var(ddof=1) if len(bgDepths) > 1 else 0;
+	if method == 'negbinom':
+		if var > mean:
+			size=mean**2/(var-mean);
+			return((method, (size, size/(size+mean))));
+		print("[Warning] background depths are not overdispersed (mean={0:.5g}, var={1:.5g}), use poisson instead of negbinom".format(mean, var), file=sys.stderr);
+	return(('poisson', (mean,)));
+
+## get p values from a background model
+def p_values(model, depths):
+	'''
+	Given a background model from fit_background() and an array of
+	depth values, return the probability of a background window having
+	a depth >= each value. For the parametric models the survival
+	function is extended to non-integer depths with the regularized
+	incomplete gamma (poisson) or beta (negbinom) functions.
+	'''
+	method, params = model;
+	if method == 'empirical':
+		return(p_for_depth(params, depths));
+	from scipy import special;
+	p=np.ones(len(depths));
+	pos=depths > 0;
+	if method == 'poisson':
+		p[pos]=special.gammainc(depths[pos], params[0]);
+	else:
+		size, prob = params;
+		p[pos]=special.betainc(depths[pos], size, 1-prob);
 	return(p);
 
+## add the windows of one chromosome to the background sample
+def update_background(bg, seen, cov, start, counts, wS, size, rng):
+	'''
+	"bg" holds the depths of a uniform sample, without replacement, of
+	at most "size" windows out of the "seen" windows so far. The
+	sample is updated with the "counts" windows of size wS of a new
+	chromosome starting at "start", so that it stays uniform over all the seen
+	windows. Only the depths of newly sampled windows are computed.
+	Returns the new sample and the number of windows seen.
+	'''
+	counts=max(counts, 0);
+	total=seen+counts;
+	if total <= size: # keep all windows
+		return((np.concatenate((bg, window_depths(cov, start, counts, wS))), total));
+	k=rng.hypergeometric(counts, seen, size); # windows taken from this chromosome
+	keep=rng.choice(len(bg), size-k, replace=False);
+	picked=rng.choice(counts, k, replace=False);
+	new=region_depths(cov, start+picked.astype(np.int64)*wS, wS);
+	return((np.concatenate((bg[keep], new)), total));
+
+## background cache
+def file_signature(infile):
+	'''
+	return the absolute path, size and modification time (in ns) of a
+	file, which identify its content for the background cache without
+	reading the file
+	'''
+	st=os.stat(infile);
+	return([os.path.abspath(infile), st.st_size, st.st_mtime_ns]);
+
+def bg_cache_file(infile, key):
+	'''
+	return the name of the background cache file for the parameters in
+	"key", which is put next to the input file
+	'''
+	keyHash=hashlib.md5(json.dumps(key, sort_keys=True).encode()).hexdigest();
+	return(infile + ".bg-" + keyHash[:16] + ".npz");
+
+def load_bg_cache(cacheFile, key):
+	'''
+	return the background depths stored in cacheFile, or None if the
+	file does not exist or was built with different parameters
+	'''
+	if not os.path.exists(cacheFile):
+		return(None);
+	try:
+		with np.load(cacheFile) as d:
+			if str(d['key']) != json.dumps(key, sort_keys=True):
+				return(None);
+			return(d['depths']);
+	except (OSError, ValueError, KeyError) as e:
+		print(f"[Warning] can't read background cache '{cacheFile}': {e}", file=sys.stderr);
+		return(None);
+
+def save_bg_cache(cacheFile, key, depths):
+	'''
+	save the background depths together with their parameters
+	'''
+	tmpFile=cacheFile+"."+str(os.getpid());
+	try:
+		with open(tmpFile, "wb") as f:
+			np.savez(f, key=np.array(json.dumps(key, sort_keys=True)),
+					depths=depths);
+		os.replace(tmpFile, cacheFile);
+	except OSError as e:
+		print(f"[Warning] can't write background cache '{cacheFile}': {e}", file=sys.stderr);
+
+## split the windows of a chromosome into chunks for scanning
+def scan_chunks(chrom, start, counts, wS, scale, cov, chunkSize):
+	'''
+	yield [chrom, start, counts, cov, scale] for consecutive chunks of
+	at most chunkSize windows of size wS, where cov only keeps the
+	blocks overlapping the chunk, so that a worker receives only its
+	slice of the bedGraph. "scale" is the index of wS in windowSizes.
+	'''
+	starts, ends, depths, cum = cov;
+	for k in range(0, max(counts,0), chunkSize):
+		n=min(chunkSize, counts-k);
+		chunkStart=start+k*wS;
+		chunkEnd=chunkStart+n*wS;
+		i0=np.searchsorted(ends, chunkStart, side='right'); # first block ending after chunk start
+		i1=np.searchsorted(starts, chunkEnd, side='left'); # blocks starting before chunk end
+		yield([chrom, chunkStart, n,
+			(starts[i0:i1], ends[i0:i1], depths[i0:i1], cum[i0:i1+1]), scale]);
+
+def init_scan(models, sizes, fdrCutoff, windowTable):
+	'''
+	set the background model and window size of each scale, FDR
+	cutoff and whether to format the per-window table in a worker
+	process
+	'''
+	global bgModels, windowSizes, fdr, writeWindows;
+	bgModels=models;
+	windowSizes=sizes;
+	fdr=fdrCutoff;
+	writeWindows=windowTable;
+
+## get the blocks overlapping a set of windows
+def overlap_blocks(cov, starts, wS):
+	'''
+	return the (starts, ends, depths) of the blocks overlapping any of
+	the windows of size wS starting at the sorted positions "starts"
+	'''
+	bStarts, bEnds, bDepths, cum = cov;
+	first=np.searchsorted(bEnds, starts, side='right');
+	last=np.searchsorted(bStarts, starts+wS, side='left');
+	# mark the block ranges [first, last) of all windows
+	mark=np.zeros(len(bStarts)+1, dtype=np.int64);
+	np.add.at(mark, first, 1);
+	np.add.at(mark, last, -1);
+	inside=np.cumsum(mark)[:-1] > 0;
+	return((bStarts[inside], bEnds[inside], bDepths[inside]));
+
+## scan one chunk of windows
+def scan_chunk(chunk):
+	'''
+	calculate the depth and p value of each window in a chunk from
+	scan_chunks(). Returns the per-window output lines as one string
+	(None unless writeWindows is set) and the candidate record
+	[chrom, starts, depths, pvalues, blocks, scale] of the windows with
+	p <= fdr, where blocks are the bedGraph blocks overlapping them.
+	Only these windows can pass the Benjamini-Hochberg cutoff.
+	'''
+	chrom, start, counts, cov, scale = chunk;
+	wS=windowSizes[scale];
+	depths=window_depths(cov, start, counts, wS);
+	pvalues=p_values(bgModels[scale], depths);
+	text=None;
+	if writeWindows:
+		lines=[];
+		for k, (d, p) in enumerate(zip(depths.tolist(), pvalues.tolist())):
+			s=start+k*wS;
+			lines.append("\t".join(map(str,[chrom, s, s+wS, d, p]))+"\n");
+		text="".join(lines);
+	cand=np.flatnonzero(pvalues <= fdr);
+	candStarts=start+cand.astype(np.int64)*wS;
+	return((text, [chrom, candStarts, depths[cand], pvalues[cand],
+		overlap_blocks(cov, candStarts, wS), scale]));
+
+## scan all chunks and collect the candidate windows
+def scan_windows(chunks, wo, cpus):
+	'''
+	scan the chunks from scan_chunks(), write the per-window lines to
+	"wo" (if not None) and collect the candidate records, both in the
+	order of the chunks. With cpus > 1, at most cpus*2 chunks are in
+	flight in a process pool, and the results are the same as a
+	single-process run. Returns the number of windows scanned at each
+	scale and the list of candidate records.
+	'''
+	counter=0;
+	scaleCounts=[0]*len(windowSizes);
+	cands=[];
+	def collect(n, res):
+		nonlocal counter;
+		text, cand=res;
+		if wo is not None:
+			wo.write(text);
+		if len(cand[1]) > 0:
+			cands.append(cand);
+		scaleCounts[cand[5]]+=n;
+		counter+=n;
+		print("{:10d} regions scanned".format(counter), file=sys.stderr);
+	if cpus > 1:
+		with cf.ProcessPoolExecutor(max_workers=cpus, initializer=init_scan,
+				initargs=(bgModels, windowSizes, fdr, writeWindows)) as executor:
+			pending=deque();
+			for c in chunks:
+				pending.append((c[2], executor.submit(scan_chunk, c)));
+				if len(pending) < cpus*2:
+					continue;
+				n, future=pending.popleft();
+				collect(n, future.result());
+			while pending:
+				n, future=pending.popleft();
+				collect(n, future.result());
+	else:
+		for c in chunks:
+			collect(c[2], scan_chunk(c));
+	return((scaleCounts, cands));
+
+## Benjamini-Hochberg q values
+def bh_qvalues(pvalues, m):
+	'''
+	return the Benjamini-Hochberg q values for "pvalues", which must be
+	the smallest p values among "m" tests
+	'''
+	order=np.argsort(pvalues, kind='stable');
+	ranked=pvalues[order]*m/np.arange(1, len(pvalues)+1);
+	ranked=np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1);
+	q=np.empty_like(ranked);
+	q[order]=ranked;
+	return(q);
+
+## trim the ends of a merged region at block resolution
+def sharpen_region(blocks, start, end, minDepth):
+	'''
+	move the ends of the region [start, end) inwards to the first and
+	last overlapping blocks with depth >= minDepth, and return the new
+	start, end and the mean depth of the new region
+	'''
+	bStarts, bEnds, bDepths = blocks;
+	i0=np.searchsorted(bEnds, start, side='right');
+	i1=np.searchsorted(bStarts, end, side='left');
+	high=np.flatnonzero(bDepths[i0:i1] >= minDepth);
+	if len(high) > 0:
+		start=max(start, int(bStarts[i0+high[0]]));
+		end=min(end, int(bEnds[i0+high[-1]]));
+	overlap=np.clip(np.minimum(bEnds[i0:i1], end)-np.maximum(bStarts[i0:i1], start), 0, None);
+	depth=(overlap*bDepths[i0:i1]).sum()/(end-start);
+	return((start, end, depth));
+
+## merge and sharpen significant windows
+def merge_windows(cands, m, wS):
+	'''
+	go through the candidate records of windows of size wS from
+	scan_windows() once, in genome order, and yield
+	[chrom, start, end, depth, p, q, wS] for each run of contiguous
+	windows with q <= fdr among the "m" scanned windows, where p and q
+	are the smallest values among the windows in the run
+	'''
+	if len(cands) < 1: return;
+	q=bh_qvalues(np.concatenate([c[3] for c in cands]), m);
+	sig=q <= fdr;
+	if not sig.any(): return;
+	minDepth=np.concatenate([c[2] for c in cands])[sig].min();
+	offsets=np.cumsum([0]+[len(c[1]) for c in cands]);
+	k=0;
+	while k < len(cands):
+		# group the records of one chromosome
+		chrom=cands[k][0];
+		j=k;
+		while j < len(cands) and cands[j][0] == chrom: j+=1;
+		sel=sig[offsets[k]:offsets[j]];
+		starts=np.concatenate([c[1] for c in cands[k:j]])[sel];
+		pvalues=np.concatenate([c[3] for c in cands[k:j]])[sel];
+		qvalues=q[offsets[k]:offsets[j]][sel];
+		blocks=[np.concatenate([c[4][x] for c in cands[k:j]]) for x in range(3)];
+		# a block overlapping two chunks is included twice
+		dup=np.concatenate(([False], blocks[0][1:] == blocks[0][:-1]));
+		blocks=[b[~dup] for b in blocks];
+		# runs of contiguous windows
+		breaks=np.flatnonzero(starts[1:] != starts[:-1]+wS)+1;
+		bounds=np.concatenate(([0], breaks, [len(starts)]));
+		for a, b in zip(bounds[:-1], bounds[1:]):
+			if a == b: continue;
+			start, end, depth=sharpen_region(blocks, int(starts[a]),
+					int(starts[b-1])+wS, minDepth);
+			yield([chrom, start, end, depth, pvalues[a:b].min(),
+				qvalues[a:b].min(), wS]);
+		k=j;
+
+def int_list(s):
+	'''
+	convert a comma-separated string into a list of integers
+	'''
+	return([int(x) for x in s.split(",")]);
+
 # set up arguments
 desc = """
 This program calls peaks/signal clusters from the read depth data.
 It achieves the goal through two steps: first, it detects candidate
 regions by sliding windows and comparing the mean read depth to the
-background; second, it sharpens the ends of the regions and connects
-contiguous regions.
+background; second, it connects contiguous windows passing the FDR
+cutoff (Benjamini-Hochberg) and sharpens the ends of the regions to
+the bedGraph blocks.
+
+Several window sizes can be scanned in one run, each against its own
+background distribution and all from the same in-memory coverage.
+
+The output is in bed format with the columns chr, start, end, mean
+depth, the smallest p value and q value of the merged windows, and the
+window size of the scale where the region was found.
 
 Default optional values are in [].
 """;
@@ -113,126 +427,244 @@ Author: Zhenguo Zhang
 Email: zhangz.sci@gmail.com
 ''';
 
-optParser = ap.ArgumentParser(
-	description=desc,
-	formatter_class=ap.RawTextHelpFormatter,
-	epilog=authorInfo
-		);
-
-## positional required arguments
-optParser.add_argument("infile",
-		help="input file with sequence depth in bedGraph format, must be already sorted in coordinates");
-optParser.add_argument("csfile",
-		help="a file containing chromosome sizes in the format 'chr<tab>size' in each row. Chromosomes present in both input files will be analyzed");
-
-## optional auxillary arguments
-optParser.add_argument("-w", "--window", 
-		help="the size of the window used for scanning candidate regions [300]",
-		type=int,
-		dest="windowSize",
-		default=300,
-		action='store'
-		);
-
-optParser.add_argument("-n",
-		help="the number of regions sampled from genome for estimating background distribution [10000]",
-		type=int,
-		dest="sampleSize",
-		default=10000,
-		action='store'
-		);
-
-optParser.add_argument("-q","--fdr",
-		help="the false discovery rate for identified peaks [0.01]",
-		type=float,
-		dest="qCutoff",
-		default=0.01,
-		action="store"
-		);
-
-optParser.add_argument("--peak-frac",
-		help="the expected fraction of genome having peaks. This number is used for trimming top depth regions [0.05]",
-		type=float,
-		dest="peakFrac",
-		default=0.05,
-		action="store"
-		);
-
-optParser.add_argument("--outfile", "-o",
-		help="output filename [stdout]",
-		dest="outFile", # for demonstration only
-		default=sys.stdout,
-		metavar="stdout");
-
-args = optParser.parse_args();
-wS=args.windowSize; # the length of each region for initial scanning
-sampleSize=args.sampleSize; # number of regions for background calculation
-fdr=args.qCutoff; # the FDR cutoff for kept regions.
-peakFrac=args.peakFrac;
-if peakFrac < 0 or peakFrac > 1: 
-	raise ValueError("The value for peakFrac should be in [0,1]");
-
-o=open(args.outFile, "w");
-
-i=1;
-print("Step {0:2d}: reading read depth data and chromosome sizes".format(i));
-
-dat=pd.read_csv(args.infile, sep="\t", header=None,
-		names=["chr","start","end","depth"], skiprows=1);
-chrSizes=pd.read_csv(args.csfile,
-sep="\t",header=None,names=["chr","size"]);
-# only consider the chromosomes existing in the data
-chrSizes=chrSizes[chrSizes['chr'].isin(dat['chr'].unique())]
-if chrSizes.empty:
-	sys.exit("No common chromosomes found between input files");
-
-i+=1;
-print("""
+if __name__ == "__main__":
+	optParser = ap.ArgumentParser(
+		description=desc,
+		formatter_class=ap.RawTextHelpFormatter,
+		epilog=authorInfo
+			);
+
+	## positional required arguments
+	optParser.add_argument("infile",
+			help="input file with sequence depth in bedGraph format, must be already sorted in coordinates. A binary coverage file from 'bincov.py convert' is also accepted");
+	optParser.add_argument("csfile",
+			help="a file containing chromosome sizes in the format 'chr<tab>size' in each row. Chromosomes present in both input files will be analyzed");
+
+	## optional auxillary arguments
+	optParser.add_argument("-w", "--window", 
+			help="the size of the window used for scanning candidate regions; a comma-separated list such as 300,1000,5000 scans at all these sizes [300]",
+			type=int_list,
+			dest="windowSizes",
+			default=[300],
+			action='store'
+			);
+
+	optParser.add_argument("-n",
+			help="the number of regions sampled from genome for estimating background distribution [10000]",
+			type=int,
+			dest="sampleSize",
+			default=10000,
+			action='store'
+			);
+
+	optParser.add_argument("-q","--fdr",
+			help="the false discovery rate for identified peaks [0.01]",
+			type=float,
+			dest="qCutoff",
+			default=0.01,
+			action="store"
+			);
+
+	optParser.add_argument("--peak-frac",
+			help="the expected fraction of genome having peaks. This number is used for trimming top depth regions [0.05]",
+			type=float,
+			dest="peakFrac",
+			default=0.05,
+			action="store"
+			);
+
+	optParser.add_argument("--background",
+			help="the background model for p values: 'empirical' uses the sampled depths directly, so p values are no smaller than 1/n; 'poisson' and 'negbinom' fit the distribution to the sampled depths and need scipy [empirical]",
+			dest="background",
+			choices=["empirical", "poisson", "negbinom"],
+			default="empirical",
+			action="store"
+			);
+
+	optParser.add_argument("--cpus",
+			help="the number of processes used for scanning windows; chromosomes are split into chunks which are scanned in parallel [1]",
+			type=int,
+			dest="cpus",
+			default=1,
+			action="store"
+			);
+
+	optParser.add_argument("--seed",
+			help="the seed for sampling background regions. When provided, the background distribution is cached in a file next to the input file and reused by later runs with the same input and parameters. The input is identified by its path, size and modification time [None]",
+			type=int,
+			dest="seed",
+			default=None,
+			action="store"
+			);
+
+	optParser.add_argument("--stream",
+			help="read the bedGraph one chromosome at a time with compact dtypes, so that memory use is bounded by the largest chromosome. The input is read twice, depth values are kept in single precision, and output follows the chromosome order of the input file",
+			dest="stream",
+			action="store_true"
+			);
+
+	optParser.add_argument("--window-table",
+			help="also write the depth and p value of every scanned window to this file [None]",
+			dest="windowFile",
+			default=None,
+			action="store"
+			);
+
+	optParser.add_argument("--outfile", "-o",
+			help="output filename [stdout]",
+			dest="outFile", # for demonstration only
+			default=sys.stdout,
+			metavar="stdout");
+
+	args = optParser.parse_args();
+	windowSizes=args.windowSizes; # the length of each region for initial scanning
+	sampleSize=args.sampleSize; # number of regions for background calculation
+	fdr=args.qCutoff; # the FDR cutoff for kept regions.
+	peakFrac=args.peakFrac;
+	if peakFrac < 0 or peakFrac > 1: 
+		raise ValueError("The value for peakFrac should be in [0,1]");
+	if args.cpus < 1:
+		raise ValueError("The value for cpus should be at least 1");
+	if min(windowSizes) < 1 or len(set(windowSizes)) < len(windowSizes):
+		raise ValueError("The window sizes should be positive and distinct");
+
+	o=args.outFile;
+	if type(o) is str:
+		o=open(o, "w");
+	writeWindows=args.windowFile is not None;
+	wo=open(args.windowFile, "w") if writeWindows else None;
+
+	i=1;
+	print("Step {0:2d}: reading read depth data and chromosome sizes".format(i), file=sys.stderr);
+
+	chrSizes=pd.read_csv(args.csfile,
+	sep="\t",header=None,names=["chr","size"]);
+	# get how many non-overlapped regions exist given the window size
+	trimSize=10000;
+	if bincov.is_bincov(args.infile):
+		# binary coverage file from bincov.py, memory-mapped
+		if args.stream:
+			print("[Info] the binary coverage file is memory-mapped, --stream is ignored", file=sys.stderr);
+			args.stream=False;
+		coverage={c: cov[:4] for c, cov in bincov.open_bincov(args.infile).items()};
+		chrSizes=chrSizes[chrSizes['chr'].isin(list(coverage))]
+		if chrSizes.empty:
+			sys.exit("No common chromosomes found between input files");
+	elif not args.stream:
+		dat=pd.read_csv(args.infile, sep="\t", header=None,
+				names=["chr","start","end","depth"],
+				skiprows=bincov.header_lines(args.infile));
+		# only consider the chromosomes existing in the data
+		chrSizes=chrSizes[chrSizes['chr'].isin(dat['chr'].unique())]
+		if chrSizes.empty:
+			sys.exit("No common chromosomes found between input files");
+		# convert the blocks of each chromosome into arrays only once,
+		# they are shared by all the window sizes
+		coverage={c: chrom_coverage(b) for c, b in dat.groupby('chr', sort=False)};
+		dat=None;
+	regions=[define_regions(chrSizes,wS,trimSize,trimSize) for wS in windowSizes];
+	regionInfo=[{c: (s, n) for c, s, n in r.itertuples(index=False)} for r in regions];
+
+	i+=1;
+	bgDepths=[None]*len(windowSizes);
+	if args.seed is not None:
+		signature=file_signature(args.infile);
+		bgKeys=[{"version": BG_CACHE_VERSION, "file": signature,
+				"chrSizes": chrSizes.values.tolist(),
+				"window": wS, "sampleSize": sampleSize,
+				"peakFrac": peakFrac, "seed": args.seed,
+				"stream": args.stream} for wS in windowSizes];
+		bgCaches=[bg_cache_file(args.infile, key) for key in bgKeys];
+		bgDepths=[load_bg_cache(f, key) for f, key in zip(bgCaches, bgKeys)];
+	missing=[k for k, bg in enumerate(bgDepths) if bg is None];
+	for k in range(len(windowSizes)):
+		if k not in missing:
+			print("Step {0:2d}: load background distribution from {1}".format(i, bgCaches[k]), file=sys.stderr);
+	if missing:
+		print("""
 Step {0:2d}: calculate background distribution with {1} sampled
-regions of length {2}""".format(i, sampleSize, wS));
-
-# get how many non-overlapped regions exist given the window size
-trimSize=10000;
-regions=define_regions(chrSizes,trimSize,trimSize);
-regionNum=regions['counts'].sum();
-# now sample regions for background calculation
-sampled=rd.sample(range(regions['counts'].sum()),int(sampleSize*(1+peakFrac)));
-bgRegions=[region_coord(regions, x) for x in sampled];
-bgDepths=[]; # store sorted depth values
-tmp=[bs.insort(bgDepths,find_overlap_blocks(dat,r, True)) for r in bgRegions];
-tmp=None;
-# trim the top x% values which may be from true binding regions
-bgDepths=pd.Series(bgDepths);
-cutoff=bgDepths.quantile(1-peakFrac);
-bgDepths=bgDepths[bgDepths<=cutoff];
-q99=bgDepths.quantile(0.99); # 99% quantile
-## what is the distribution look like: poisson or guassian?
-bgFile="bg-depth."+str(os.getpid())+".csv";
-bgDepths.to_csv(bgFile, index=False);
-bgDepths=bgDepths.tolist();
-
-i+=1;
-# this is the slowest step
-print("Step {0:2d}: scan for significant regions with FDR={1:.2f}".format(i, fdr));
-counter=0;
-results=[]; # here we will store only regions with p < 0.1 ?
-for j in range(1,regionNum+1):
-	r=region_coord(regions,j);
-	d=find_overlap_blocks(dat,r, True);
-	p=p_for_depth(bgDepths,d);
-	r.extend([d,p]);
-	#results.append([d,p]);
-	o.write("\t".join(map(str,r))+"\n");
-	counter+=1;
-	if counter % 10000 == 0:
-		print("{:10d} regions scanned".format(counter), file=sys.stderr);
+regions of length {2}""".format(i, sampleSize,
+	",".join(str(windowSizes[k]) for k in missing)), file=sys.stderr);
 
-i+=1;
-print("Step {0:2d}: merge and sharpen regions".format(i));
+		bgSize=int(sampleSize*(1+peakFrac));
+		# each window size has its own random stream, so that its sample
+		# only depends on its cache key, not on the other sizes in the run
+		seeds={k: None if args.seed is None else [args.seed, windowSizes[k]]
+				for k in missing};
+		if args.stream:
+			# sample windows of all sizes while streaming over the chromosomes
+			rngs={k: np.random.default_rng(seeds[k]) for k in missing};
+			seen=[0]*len(windowSizes);
+			for k in missing: bgDepths[k]=np.zeros(0);
+			for chrom, blocks in bincov.read_bedgraph(args.infile):
+				if chrom not in regionInfo[0]: continue;
+				cov=chrom_coverage(blocks);
+				for k in missing:
+					start, counts=regionInfo[k][chrom];
+					bgDepths[k], seen[k]=update_background(bgDepths[k], seen[k],
+							cov, start, counts, windowSizes[k], bgSize, rngs[k]);
+			if max(seen) == 0:
+				sys.exit("No common chromosomes found between input files");
+		else:
+			# now sample regions for background calculation
+			for k in missing:
+				wS=windowSizes[k];
+				regionNum=regions[k]['counts'].sum();
+				rand=rd.Random(None if seeds[k] is None else "{0}:{1}".format(*seeds[k]));
+				sampled=rand.sample(range(regionNum),min(bgSize,regionNum));
+				chrIndex, bgStarts=region_coords(regions[k], np.array(sampled, dtype=np.int64), wS);
+				bgDepths[k]=np.zeros(len(sampled));
+				for j, chrom in enumerate(regions[k]['chr']):
+					sel=chrIndex==j;
+					if sel.any():
+						bgDepths[k][sel]=region_depths(coverage[chrom], bgStarts[sel], wS);
+		for k in missing:
+			bg=np.sort(bgDepths[k]); # sort once, for searchsorted below
+			# trim the top x% values which may be from true binding regions
+			cutoff=np.quantile(bg, 1-peakFrac);
+			bgDepths[k]=bg[bg<=cutoff];
+			if args.seed is not None:
+				save_bg_cache(bgCaches[k], bgKeys[k], bgDepths[k]);
+	bgModels=[fit_background(bg, args.background) for bg in bgDepths];
+	for wS, (method, params) in zip(windowSizes, bgModels):
+		if method != 'empirical':
+			print("[Info] {0} background for window size {1}: {2}".format(
+				method, wS, ", ".join("{:.5g}".format(x) for x in params)), file=sys.stderr);
+
+	i+=1;
+	# this is the slowest step
+	print("Step {0:2d}: scan for significant regions with FDR={1:.2f}".format(i, fdr), file=sys.stderr);
+	chunkSize=500000; # windows per chunk
+	if args.stream:
+		chunks=(c for chrom, cov in ((chrom, chrom_coverage(blocks))
+					for chrom, blocks in bincov.read_bedgraph(args.infile)
+					if chrom in regionInfo[0])
+				for k, wS in enumerate(windowSizes)
+				for c in scan_chunks(chrom, *regionInfo[k][chrom], wS, k,
+					cov, chunkSize));
+	else:
+		chunks=(c for chrom in regions[0]['chr']
+				for k, wS in enumerate(windowSizes)
+				for c in scan_chunks(chrom, *regionInfo[k][chrom], wS, k,
+					coverage[chrom], chunkSize));
+	scaleCounts, cands=scan_windows(chunks, wo, args.cpus);
+	if wo is not None:
+		wo.close();
 
-# output the results
+	i+=1;
+	print("Step {0:2d}: merge and sharpen regions".format(i), file=sys.stderr);
 
-o.close();
+	# merge each scale on its own and output the regions of all scales
+	# in genome order
+	chromOrder={};
+	for c in cands: chromOrder.setdefault(c[0], len(chromOrder));
+	peaks=[p for k, wS in enumerate(windowSizes)
+			for p in merge_windows([c for c in cands if c[5] == k],
+				scaleCounts[k], wS)];
+	peaks.sort(key=lambda p: (chromOrder[p[0]], p[1], p[6]));
+	for peak in peaks:
+		print("{0}\t{1}\t{2}\t{3:.5g}\t{4:.5g}\t{5:.5g}\t{6}".format(*peak), file=o);
 
-print("Job is done!!", file=sys.stderr);
+	o.close();
 
+	print("Job is done!!", file=sys.stderr);
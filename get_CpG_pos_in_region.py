@@ -2,12 +2,23 @@
 
 import sys;
 import argparse as ap;
-import subprocess as sp;
 import concurrent.futures
 import threading
 import multiprocessing
+import os
+import time
+import traceback
+import gzip
+import numpy as np
+import twobit
 
-VERSION='0.0.2'
+VERSION='0.0.3'
+
+genome=None # the 2bit reader, opened once in each process
+cpgIndex=None # the CpG index, loaded once in each process
+limit=None # the InFlightLimit of chunks not yet written
+tuner=None # the AutoTuner with --auto, which is also the limit
+checkpoint=None # the Checkpoint with --checkpoint
 
 # functions
 def CpG_pos(s):
@@ -23,23 +34,165 @@ def CpG_pos(s):
 		yield last_found;
 
 
+# bit masks of bases and IUPAC codes: A=1, C=2, G=4, T=8
+IUPAC={'A':1, 'C':2, 'G':4, 'T':8, 'R':5, 'Y':10, 'S':6, 'W':9,
+		'K':12, 'M':3, 'B':14, 'D':13, 'H':11, 'V':7, 'N':15};
+COMPLEMENT=str.maketrans("ACGTRYSWKMBDHVN", "TGCAYRSWMKVHDBN");
+BASE_MASK=np.zeros(256, dtype=np.uint8);
+for b in "ACGT":
+	BASE_MASK[ord(b)]=BASE_MASK[ord(b.lower())]=IUPAC[b];
+
+def parse_motifs(s):
+	'''
+	parse comma-separated motifs in IUPAC codes, such as 'CG,CHG,CHH',
+	into a list of (motif, forward masks, reverse-strand masks), where
+	the reverse-strand masks are None for palindromic motifs
+	'''
+	motifs=[];
+	for m in s.upper().split(","):
+		if m == '' or any(c not in IUPAC for c in m):
+			raise ValueError(f"Invalid motif '{m}'");
+		rc=m.translate(COMPLEMENT)[::-1];
+		fwd=np.array([IUPAC[c] for c in m], dtype=np.uint8);
+		rev=None if rc == m else np.array([IUPAC[c] for c in rc], dtype=np.uint8);
+		motifs.append((m, fwd, rev));
+	return(motifs);
+
+def motif_pos(codes, offset, motifs):
+	'''
+	find all the motifs from parse_motifs() on both strands of a
+	sequence given as ASCII codes. The sequence is converted into base
+	masks once, and each motif is matched with vectorized masks.
+	Returns, for each motif, the sorted positions (plus offset) and the
+	strands ('+' or '-') of the matches.
+	'''
+	m=BASE_MASK[codes];
+	res=[];
+	for name, fwd, rev in motifs:
+		n=len(m)-len(fwd)+1;
+		pos=[];
+		strands=[];
+		for masks, strand in ((fwd, '+'), (rev, '-')):
+			if masks is None or n < 1: continue;
+			ok=np.ones(n, dtype=bool);
+			for j, mask in enumerate(masks):
+				ok&=(m[j:j+n] & mask) != 0;
+			hit=np.flatnonzero(ok);
+			pos.append(hit);
+			strands.append(np.full(len(hit), strand));
+		if not pos:
+			res.append((np.zeros(0, dtype=np.int64), np.zeros(0, dtype='<U1')));
+			continue;
+		pos=np.concatenate(pos);
+		strands=np.concatenate(strands);
+		order=np.argsort(pos, kind='stable'); # '+' before '-' at the same position
+		res.append((pos[order]+offset, strands[order]));
+	return(res);
+
 def get_seq(chrom, start, end):
 	'''
-	Get sequence for a given region
+	Get sequence for a given region, the same as twoBitToFa. The 2bit
+	file is memory-mapped once per process and only the bytes of the
+	region are decoded.
+	'''
+	global genome;
+	if genome is None:
+		genome=twobit.TwoBit(args.twobitFile);
+	return(genome.seq(chrom, int(start), int(end)));
+
+def load_CpG_index(indexDir):
+	'''
+	Load the chromosome sizes of a CpG index from build_CpG_index.py.
+	The CpG positions of each chromosome are memory-mapped on first use.
+	'''
+	sizes={};
+	with open(os.path.join(indexDir, "chrom.sizes"), 'r') as f:
+		for l in f:
+			chrom, size=l.rstrip("\n").split("\t");
+			sizes[chrom]=int(size);
+	return({'dir': indexDir, 'sizes': sizes, 'pos': {}});
+
+def index_CpG_pos(records):
+	'''
+	Find the CpG positions of the regions [chrom, start, end, ...]
+	from the CpG index, with two binary searches per region. Regions
+	are searched in batches per chromosome. Returns, for each region,
+	the array of CpG start positions, or None if the region is not
+	within a chromosome.
 	'''
-	seq=sp.run(['twoBitToFa', args.twobitFile, 'stdout',
-		"-seq="+chrom,"-start="+start,"-end="+end], stdout=sp.PIPE,
-		universal_newlines=True);
-	if seq.stdout == '': return(None);
-	seq=seq.stdout.split("\n")[1:];
-	seq=''.join(seq);
-	return(seq);
+	global cpgIndex;
+	if cpgIndex is None:
+		cpgIndex=load_CpG_index(args.cpgIndex);
+	res=[None]*len(records);
+	byChrom={};
+	for i, r in enumerate(records):
+		byChrom.setdefault(r[0], []).append(i);
+	for chrom, idx in byChrom.items():
+		if chrom not in cpgIndex['sizes']: continue;
+		if chrom not in cpgIndex['pos']:
+			cpgIndex['pos'][chrom]=np.load(os.path.join(cpgIndex['dir'],
+				chrom + ".npy"), mmap_mode='r');
+		pos=cpgIndex['pos'][chrom];
+		starts=np.array([int(records[i][1]) for i in idx]);
+		ends=np.array([int(records[i][2]) for i in idx]);
+		first=np.searchsorted(pos, starts, side='left');
+		last=np.searchsorted(pos, ends-1, side='left'); # a CpG must end within the region
+		for i, e, i0, i1 in zip(idx, ends.tolist(), first.tolist(), last.tolist()):
+			if e <= cpgIndex['sizes'][chrom]:
+				res[i]=pos[i0:i1];
+	return(res);
+
+def batch_motif_pos(records, motifs):
+	'''
+	Find the motif positions of the regions [chrom, start, end, ...] in
+	batches per chromosome: overlapping or adjacent regions are merged
+	into clusters, and each cluster is decoded and scanned only once.
+	Returns, for each region, the result of motif_pos() limited to the
+	region, or None if the region is not within a chromosome.
+	'''
+	global genome;
+	if genome is None:
+		genome=twobit.TwoBit(args.twobitFile);
+	res=[None]*len(records);
+	byChrom={};
+	for i, r in enumerate(records):
+		byChrom.setdefault(r[0], []).append(i);
+	for chrom, idx in byChrom.items():
+		size=genome.size(chrom);
+		if size is None: continue;
+		starts=np.array([int(records[i][1]) for i in idx]);
+		ends=np.array([int(records[i][2]) for i in idx]);
+		ok=ends <= size;
+		idx=np.array(idx)[ok];
+		starts=starts[ok];
+		ends=ends[ok];
+		if len(idx) == 0: # all the regions run past the chromosome end
+			continue;
+		order=np.argsort(starts, kind='stable');
+		idx, starts, ends = idx[order], starts[order], ends[order];
+		# a new cluster starts where a region starts after all the
+		# previous regions end
+		prevEnd=np.maximum.accumulate(ends);
+		newCluster=np.concatenate(([True], starts[1:] > prevEnd[:-1]));
+		bounds=np.flatnonzero(np.concatenate((newCluster, [True])));
+		for a, b in zip(bounds[:-1], bounds[1:]):
+			cs, ce = int(starts[a]), int(prevEnd[b-1]);
+			hits=motif_pos(genome.codes(chrom, cs, ce), cs, motifs);
+			for i in idx[a:b].tolist():
+				res[i]=[];
+			for (name, fwd, rev), (pos, strands) in zip(motifs, hits):
+				# a motif must end within the region
+				first=np.searchsorted(pos, starts[a:b], side='left');
+				last=np.searchsorted(pos, ends[a:b]-len(fwd), side='right');
+				for i, i0, i1 in zip(idx[a:b].tolist(), first.tolist(), last.tolist()):
+					res[i].append((pos[i0:i1], strands[i0:i1]));
+	return(res);
 
 # Function to process a chunk of lines
 def process_lines(chunk):
     sep, countOnly = chunk[-2], chunk[-1]
     chunk = chunk[:-2]
-    results = []
+    records = []
     for l in chunk:
         l = l.strip().split(sep)
         (chrom, start, end, name) = l[:4]
@@ -51,13 +204,28 @@ def process_lines(chunk):
         if int(start) >= int(end):
             print(f"Start coordinate >= end coordinate for [{l}]", file=sys.stderr)
             continue
-        # get sequence
-        seq = get_seq(chrom, start, end)
-        if seq is None:
+        records.append([chrom, start, end, name, l])
+    if motifs is not None:
+        return format_motifs(records, sep, countOnly)
+    # get CpG positions now
+    if args.cpgIndex:
+        allPoses = index_CpG_pos(records)
+    elif args.batch:
+        allPoses = [None if r is None else r[0][0]
+                for r in batch_motif_pos(records, parse_motifs("CG"))]
+    else:
+        allPoses = []
+        for chrom, start, end, name, l in records:
+            seq = get_seq(chrom, start, end)
+            if seq is None:
+                allPoses.append(None)
+                continue
+            allPoses.append([int(start) + p for p in CpG_pos(seq)])
+    results = []
+    for (chrom, start, end, name, l), poses in zip(records, allPoses):
+        if poses is None:
             print(f"Cannot get sequence for [{l}]", file=sys.stderr)
             continue
-        # get CpG positions now
-        poses = list(CpG_pos(seq))
         if countOnly:
             # Count only
             results.append(sep.join(map(str, [chrom, start, end, name, len(poses)])))
@@ -66,33 +234,257 @@ def process_lines(chunk):
         if len(poses) < 1:  # no CpGs
             results.append(sep.join(map(str, [chrom, start, end, name + '.CpG.NA'])))
         else:
-            start = int(start)
-            for i, p in enumerate(poses, start=1):
-                results.append(sep.join(map(str, [chrom, start + p, start + p + 2, name + ".CpG." + str(i)])))
+            for i, p in enumerate(poses.tolist() if isinstance(poses, np.ndarray) else poses, start=1):
+                results.append(sep.join(map(str, [chrom, p, p + 2, name + ".CpG." + str(i)])))
     return results
 
+def format_motifs(records, sep, countOnly):
+    '''
+    find the motifs in the regions and format the output lines: with
+    countOnly, one count column per motif; otherwise one line per match
+    with the motif and strand columns, or name.motif.NA when a motif is
+    not found
+    '''
+    global genome
+    if args.batch:
+        allHits = batch_motif_pos(records, motifs)
+    else:
+        if genome is None:
+            genome = twobit.TwoBit(args.twobitFile)
+        allHits = []
+        for chrom, start, end, name, l in records:
+            codes = genome.codes(chrom, int(start), int(end))
+            allHits.append(None if codes is None else
+                    motif_pos(codes, int(start), motifs))
+    results = []
+    for (chrom, start, end, name, l), hits in zip(records, allHits):
+        if hits is None:
+            print(f"Cannot get sequence for [{l}]", file=sys.stderr)
+            continue
+        if countOnly:
+            results.append(sep.join(map(str, [chrom, start, end, name] +
+                [len(pos) for pos, strands in hits])))
+            continue
+        for (motif, fwd, rev), (pos, strands) in zip(motifs, hits):
+            if len(pos) < 1:
+                results.append(sep.join([chrom, start, end,
+                    name + '.' + motif + '.NA', motif, '.']))
+                continue
+            for i, (p, st) in enumerate(zip(pos.tolist(), strands.tolist()), start=1):
+                results.append(sep.join(map(str, [chrom, p, p + len(fwd),
+                    name + '.' + motif + '.' + str(i), motif, st])))
+    return results
+
+def region_chroms(region_file, sep):
+    '''
+    return the chromosomes in a region file, in the order of first
+    appearance
+    '''
+    chroms = {}
+    with open(region_file, 'r') as r:
+        for l in r:
+            chroms[l.split(sep, 1)[0]] = None
+    return list(chroms)
+
+def parse_size(s):
+    '''
+    convert a memory size such as 500M or 2G into bytes
+    '''
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    s = s.strip().upper().rstrip('B')
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+class InFlightLimit:
+    '''
+    Limit the number of chunks in flight (submitted but not yet
+    written), so that the results waiting in the writer for a slow
+    earlier chunk are bounded as well as the chunks in the queue. The
+    producer waits for a slot before submitting each chunk, and the
+    writer frees one after writing each chunk.
+    '''
+    def __init__(self, inFlight):
+        self.inFlight = multiprocessing.Value('i', inFlight)
+        self.written = multiprocessing.Value('i', 0)
+        self.cond = multiprocessing.Condition()
+
+    def wait_slot(self, seqNum):
+        '''
+        called by the producer: block until chunk seqNum can be submitted
+        '''
+        with self.cond:
+            self.cond.wait_for(lambda: seqNum - self.written.value < self.inFlight.value)
+
+    def chunk_written(self):
+        with self.cond:
+            self.written.value += 1
+            self.cond.notify_all()
+
+class AutoTuner(InFlightLimit):
+    '''
+    Adjust the chunk size and the number of chunks in flight (submitted
+    but not yet written) at runtime. The writer feeds in the processing
+    time, the time the consumer waited for the chunk and the size of
+    each chunk; the chunk size moves toward the number of lines a worker
+    processes in the target time, more chunks are allowed in flight
+    while workers wait for input, and both are limited so that the
+    chunks in flight fit in the memory budget. The producer reads the
+    current values before making each chunk.
+    '''
+    LINE_OVERHEAD = 100 # bytes of Python objects per line, in addition to the text
+    MIN_CHUNK = 10
+
+    def __init__(self, cpus, chunkSize, targetSecs, maxMemory):
+        super().__init__(cpus * 2)
+        self.chunkSize = multiprocessing.Value('i', chunkSize)
+        self.minInFlight = cpus + 1
+        self.targetSecs = targetSecs
+        self.maxMemory = maxMemory
+        # statistics, kept by the writer
+        self.rate = None # lines per second per worker
+        self.lineBytes = None
+        self.chunks = 0
+        self.procSecs = 0
+        self.waitSecs = 0
+
+    def update(self, lines, procSecs, waitSecs, nbytes):
+        '''
+        called by the writer with the statistics of each chunk
+        '''
+        self.chunks += 1
+        self.procSecs += procSecs
+        self.waitSecs += waitSecs
+        alpha = 0.3 # weight of the newest chunk in the moving averages
+        rate = lines / max(procSecs, 1e-6)
+        lineBytes = nbytes / lines + self.LINE_OVERHEAD
+        if self.rate is None:
+            self.rate, self.lineBytes = rate, lineBytes
+        else:
+            self.rate = alpha * rate + (1 - alpha) * self.rate
+            self.lineBytes = alpha * lineBytes + (1 - alpha) * self.lineBytes
+        inFlight = self.inFlight.value
+        if waitSecs > 0.1 * procSecs: # workers are starving
+            inFlight += 1
+        size = self.chunkSize.value
+        size = min(max(int(self.rate * self.targetSecs), size // 2), size * 2)
+        maxLines = self.maxMemory / self.lineBytes # lines that fit in memory
+        inFlight = max(self.minInFlight,
+                min(inFlight, int(maxLines / max(size, self.MIN_CHUNK))))
+        size = max(self.MIN_CHUNK, min(size, int(maxLines / inFlight)))
+        with self.cond:
+            self.chunkSize.value = size
+            self.inFlight.value = inFlight
+            self.cond.notify_all()
+
+    def report(self):
+        busy = self.procSecs + self.waitSecs
+        print(f"[Info] --auto: chunk size {self.chunkSize.value}, "
+                f"{self.inFlight.value} chunks in flight; {self.chunks} chunks "
+                f"took {self.procSecs / max(self.chunks, 1):.3g} seconds each on average, "
+                f"and workers waited for input {self.waitSecs / max(busy, 1e-6):.1%} of the time",
+                file=sys.stderr)
+
+class Checkpoint:
+    '''
+    The record of a run for --checkpoint, so that a killed run can be
+    resumed. After each chunk is written and synced to the output file,
+    a line "seqNum<TAB>lines done<TAB>output bytes" is appended to the
+    checkpoint file. On restart, the output is truncated to the bytes of
+    the last recorded chunk and appended to, and the producer skips the
+    lines already done. The first line of the file identifies the run,
+    so a checkpoint is not resumed with different inputs or options.
+    '''
+    def __init__(self, path, key):
+        self.path = path
+        self.seq = 0 # the first chunk to process
+        self.lines = 0 # the input lines done
+        self.offset = 0 # the output bytes done
+        header = "# " + key + "\n"
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                if f.readline().decode() != header:
+                    sys.exit(f"The checkpoint '{path}' is from a different run")
+                end = f.tell() # the bytes up to the last complete record
+                for l in f:
+                    if not l.endswith(b"\n"): # an incomplete record
+                        break
+                    seqNum, self.lines, self.offset = map(int, l.split(b"\t"))
+                    self.seq = seqNum + 1
+                    end += len(l)
+            with open(path, 'r+b') as f:
+                f.truncate(end) # drop an incomplete record
+            self.fh = open(path, 'a')
+        else:
+            self.fh = open(path, 'w')
+            self.fh.write(header)
+            self.sync(self.fh)
+
+    @staticmethod
+    def sync(fh):
+        fh.flush()
+        os.fsync(fh.fileno())
+
+    def open_output(self, outFile):
+        '''
+        open the output file to continue from the last recorded chunk
+        '''
+        if self.seq > 0:
+            if not os.path.exists(outFile) or os.path.getsize(outFile) < self.offset:
+                sys.exit(f"The output '{outFile}' is shorter than recorded in the checkpoint '{self.path}'")
+            print(f"[Info] Resume from line {self.lines + 1} ({self.seq} chunks done)", file=sys.stderr)
+            with open(outFile, 'r+b') as f:
+                f.truncate(self.offset) # drop output after the last record
+            return open(outFile, 'a', buffering=1 << 20)
+        return open(outFile, 'w', buffering=1 << 20)
+
+    def record(self, seqNum, lines, out):
+        '''
+        record a chunk after its output is written
+        '''
+        self.sync(out)
+        self.seq = seqNum + 1
+        self.lines += lines
+        self.offset = out.tell()
+        self.fh.write(f"{seqNum}\t{self.lines}\t{self.offset}\n")
+        self.sync(self.fh)
+
+    def close(self):
+        self.fh.close()
+
 # producer function
 def write_chunk_to_queue(region_file,sep, chunk_size, countOnly, consumer_count):
     with open(region_file, 'r') as r:
         counter = 0
+        seqNum = 0 # the sequence number of each chunk, for ordering output
         chunk = []
+        if checkpoint is not None: # skip the chunks done
+            for _ in range(checkpoint.lines):
+                r.readline()
+            counter = checkpoint.lines
+            seqNum = checkpoint.seq
+        if tuner is not None:
+            chunk_size = tuner.chunkSize.value
         for l in r:
             counter += 1
             chunk.append(l)
 
-            if counter % chunk_size == 0:
+            if len(chunk) >= chunk_size:
                 print(f"# Start processing line {counter}", file=sys.stderr)
                 # Submit chunk for processing
                 chunk.extend([sep, countOnly])  # Pass sep and countOnly with chunk
-                #futures.append(executor.submit(limited_process_lines, chunk))
-                q.put(chunk)
+                limit.wait_slot(seqNum)
+                if tuner is not None:
+                    chunk_size = tuner.chunkSize.value
+                q.put((seqNum, chunk))
+                seqNum += 1
                 chunk = []
 
         # last chunk
         if chunk:
             chunk.extend([sep, countOnly])
-            q.put(chunk)
-            #futures.append(executor.submit(limited_process_lines, chunk))
+            limit.wait_slot(seqNum)
+            q.put((seqNum, chunk))
 
     # Put None as sentinel values for each consumer to stop processing
     for _ in range(consumer_count):
@@ -101,18 +493,81 @@ def write_chunk_to_queue(region_file,sep, chunk_size, countOnly, consumer_count)
 # consumer function
 def process_chunk_from_queue(consumer_id):
     while True:
-        chunk = q.get()
-        if chunk is None: # Check for the sentinel to stop consuming
+        t0 = time.perf_counter()
+        item = q.get()
+        if item is None: # Check for the sentinel to stop consuming
+            break
+        # process the chunk now, and send the results as one block with
+        # (lines, processing seconds, waiting seconds, bytes)
+        seqNum, chunk = item
+        t1 = time.perf_counter()
+        try:
+            results = process_lines(chunk)
+        except Exception as e: # pass the error to the writer and stop
+            traceback.print_exc()
+            rq.put(e)
             break
-        # process the chunk now
-        results = process_lines(chunk)
-        with write_lock:
-            for line in results:
-                print(line)
+        block = "".join(line + "\n" for line in results)
+        lines = chunk[:-2]
+        stats = (len(lines), time.perf_counter() - t1, t1 - t0,
+                sum(map(len, lines)) + len(block))
+        rq.put((seqNum, block, stats))
+    rq.put(None)
     print(f"Consumer {consumer_id} finished", file=sys.stderr)
 
+# writer function
+def write_results(out, consumer_count):
+    '''
+    The single writer: collect the result blocks from all consumers and
+    write them in the order of the chunk sequence numbers, so that the
+    output is the same for any number of consumers. If a consumer fails,
+    the other consumers are stopped, and its error is raised after all
+    of them have finished.
+    '''
+    pending = {}
+    nextSeq = 0 if checkpoint is None else checkpoint.seq
+    finished = 0
+    error = None
+    while finished < consumer_count:
+        item = rq.get()
+        if item is None:
+            finished += 1
+            continue
+        if isinstance(item, Exception):
+            if error is None:
+                error = item
+                for _ in range(consumer_count):
+                    q.put(None)
+            continue
+        if error is not None: # drop the results after an error
+            continue
+        seqNum, block, stats = item
+        pending[seqNum] = (block, stats[0])
+        if tuner is not None:
+            tuner.update(*stats)
+        while nextSeq in pending:
+            block, lines = pending.pop(nextSeq)
+            out.write(block)
+            if checkpoint is not None:
+                checkpoint.record(nextSeq, lines, out)
+            nextSeq += 1
+            limit.chunk_written()
+    if error is not None:
+        raise error
+
+def open_output(outFile):
+    '''
+    open the output file with a large buffer; gzip-compressed if the
+    name ends with .gz
+    '''
+    if outFile is None or outFile == '-':
+        return sys.stdout
+    if outFile.endswith(".gz"):
+        return gzip.open(outFile, 'wt', compresslevel=6)
+    return open(outFile, 'w', buffering=1 << 20)
+
 # Main parallel processing function using concurrent.futures.ProcessPoolExecutor
-def parallel_process(region_file, sep, countOnly, num_workers=4,
+def parallel_process(region_file, sep, countOnly, out, num_workers=4,
         chunk_size=1000):
 
     # Producer process
@@ -128,12 +583,17 @@ def parallel_process(region_file, sep, countOnly, num_workers=4,
         consumer_futures = [
                 executor.submit(process_chunk_from_queue, i) 
                 for i in range(num_workers)]    
+
+        # write results in this process while consumers are running
+        try:
+            write_results(out, num_workers)
+        except Exception:
+            producer_process.terminate() # it may wait for a free slot
+            raise
         
         # wait for all consumers to finish
         for future in concurrent.futures.as_completed(consumer_futures):
             future.result()
-            #print("Collected one consumer", file=sys.stderr)
-            #consumer_futures.remove(future)  # Remove completed future to free memory
 
     # Wait for the producer to finish
     producer_process.join()
@@ -143,7 +603,9 @@ if __name__ == "__main__":
 
     desc='''
     This program finds all the CpG positions in given genomic regions.
-    The output is in bed format.
+    The output is in bed format. With --motifs, other motifs such as
+    the methylation contexts CHG and CHH are found on both strands in
+    the same pass.
     ''';
     
     authorInfo='''
@@ -163,12 +625,37 @@ if __name__ == "__main__":
     
     optParser.add_argument("twobitFile",
     		help="the .2bit file from which sequences can be extracted");
+
+    optParser.add_argument("--cpg-index",
+    		help="the CpG index folder built by build_CpG_index.py from the same .2bit file. If provided, CpG positions are looked up from the index instead of scanning sequences",
+    		default=None,
+    		dest='cpgIndex')
+    
+    optParser.add_argument("--batch",
+    		help="if provided, the regions in each chunk are grouped by chromosome, and overlapping or adjacent regions are merged so that each base is decoded and scanned only once",
+    		action='store_true',
+    		dest='batch')
+    
+    optParser.add_argument("--shared-genome",
+    		help="if provided, the chromosomes in the region file are decoded once into shared memory before the workers start, and all workers read sequences from there, so the memory per worker doesn't grow with --cpus. Needs memory of about one byte per base of these chromosomes",
+    		action='store_true',
+    		dest='sharedGenome')
+    
+    optParser.add_argument("-m", "--motifs",
+    		help="comma-separated motifs in IUPAC codes to find instead of CpGs, such as CG,CHG,CHH or GCWGC. Both strands are searched, and the motif and strand columns are added to the output; with --count-only, one count per motif is reported. Can't be used with --cpg-index",
+    		default=None,
+    		dest='motifs')
     
     optParser.add_argument("-c", "--count-only",
     		help="if provided, only the number of CpGs in each region is returned",
     		action='store_true',
     		dest='countOnly')
     
+    optParser.add_argument("-o", "--outfile", default=None,
+    		help="the output file; compressed with gzip if the name ends with .gz [stdout]",
+    		action='store',
+    		dest='outFile')
+    
     optParser.add_argument("--cpus", default=1, type=int,
     		help="the number of cpus to run in parallel [%(default)d]",
     		action='store',
@@ -179,6 +666,26 @@ if __name__ == "__main__":
     		action='store',
     		dest='chunkSize')
     
+    optParser.add_argument("--auto",
+    		help="if provided, the chunk size and the number of chunks in flight are adjusted at runtime from the measured time per chunk and the time workers wait for input, starting from --chunk-size. The chosen settings are reported at the end",
+    		action='store_true',
+    		dest='auto')
+    
+    optParser.add_argument("--target-latency", default=1.0, type=float,
+    		help="with --auto, the target processing time of a chunk in seconds [%(default)s]",
+    		action='store',
+    		dest='targetLatency')
+    
+    optParser.add_argument("--max-memory", default="1G",
+    		help="with --auto, the memory budget for the chunks in flight and their results, such as 500M or 4G [%(default)s]",
+    		action='store',
+    		dest='maxMemory')
+    
+    optParser.add_argument("--checkpoint", default=None,
+    		help="a file to record the chunks written, so that a killed run can be resumed by running the same command again: finished chunks are skipped and the output file is appended to. Needs a plain output file by -o",
+    		action='store',
+    		dest='checkpoint')
+    
     optParser.add_argument("-v", "--version",
         action='version', version=VERSION,
         help="show version number and exit"
@@ -187,18 +694,70 @@ if __name__ == "__main__":
     args=optParser.parse_args();
     sep="\t";
 
-    #max_queue_size = args.cpus * 2  # Limit the number of active submissions
-    # use a queue to control how many tasks can be in submission
-    q = multiprocessing.Queue(maxsize=args.cpus*2)
+    motifs=None
+    if args.motifs is not None:
+        if args.cpgIndex:
+            optParser.error("--motifs can't be used with --cpg-index")
+        try:
+            motifs=parse_motifs(args.motifs)
+        except ValueError as e:
+            optParser.error(str(e))
+
+    # limit the chunks submitted but not yet written to cpus*2; with
+    # --auto, the tuner adjusts the limit
+    if args.auto:
+        try:
+            maxMemory = parse_size(args.maxMemory)
+        except ValueError:
+            optParser.error(f"Invalid --max-memory '{args.maxMemory}'")
+        tuner = AutoTuner(args.cpus, args.chunkSize, args.targetLatency, maxMemory)
+        limit = tuner
+    else:
+        limit = InFlightLimit(args.cpus * 2)
+    q = multiprocessing.Queue()
     
-    # also use a write lock to control writing to output
-    write_lock = multiprocessing.Lock()
+    # consumers send their results to the writer through this queue
+    rq = multiprocessing.Queue()
 
+    if args.checkpoint:
+        if args.outFile is None or args.outFile == '-' or args.outFile.endswith(".gz"):
+            optParser.error("--checkpoint needs an uncompressed output file by -o")
+        # the options changing the output identify the run
+        key = "\t".join(map(str, [os.path.abspath(args.regionFile),
+            os.path.abspath(args.outFile), os.path.basename(args.twobitFile),
+            args.motifs, args.countOnly]))
+        checkpoint = Checkpoint(args.checkpoint, key)
+        out = checkpoint.open_output(args.outFile)
+        limit.written.value = checkpoint.seq
+    else:
+        out = open_output(args.outFile)
+
+    # after all the options are checked, so that the blocks are always freed
+    if args.sharedGenome and args.cpgIndex:
+        print("[Warning] --shared-genome is ignored with --cpg-index", file=sys.stderr)
+    elif args.sharedGenome:
+        # decode the needed chromosomes once; the workers inherit the
+        # reader and attach to the shared blocks
+        genome = twobit.SharedGenome(args.twobitFile, region_chroms(args.regionFile, sep))
+        print(f"[Info] {len(genome.names())} chromosomes decoded into shared memory", file=sys.stderr)
 
     # Usage
-    parallel_process(args.regionFile, sep, args.countOnly,
-            num_workers=args.cpus,
-            chunk_size=args.chunkSize)
+    try:
+        parallel_process(args.regionFile, sep, args.countOnly, out,
+                num_workers=args.cpus,
+                chunk_size=args.chunkSize)
+    finally:
+        if isinstance(genome, twobit.SharedGenome):
+            genome.close()
+
+    if out is not sys.stdout:
+        out.close()
+
+    if checkpoint is not None:
+        checkpoint.close()
+
+    if tuner is not None:
+        tuner.report()
 
     print("Job is done", file=sys.stderr);
 
@@ -3,6 +3,12 @@
 from __future__ import print_function;
 import sys;
 import argparse as ap;
+import io;
+import re;
+import csv;
+import numpy as np;
+import pandas as pd;
+from itertools import islice, repeat;
 
 # functions
 def warn(s):
@@ -10,60 +16,196 @@ def warn(s):
 	'''
 	print(f"[Warning] {s}", file=sys.stderr);
 
-def output(c):
-	'''output the crowdedness parameters
+def crowdedness(starts, ends, blockPairs=10000000):
+	'''calculate the following crowdedness parameters for all the
+	regions of one chromosome, given the arrays of starts and ends in
+	the input order (sorted by starts):
+	1. minD, the distance from the closest region, -1 if no regions
+	within the considered window.
+	2. nr, the number of regions within the considered window.
+	3. sr, the sum of reciprocals of distances to these regions, with
+	1 for distances <= 0.
+	The regions considered are those of a window sliding along the
+	regions: the regions after a focus region are all those up to the
+	first region starting at least afterDist after its end, but never
+	fewer than for the previous focus; the regions before it are those
+	ending less than beforeDist before its start, and all of them are
+	dropped when a focus has no regions after it. minD is from the
+	last region before and the first region after the focus. The
+	window bounds are found with searchsorted, and the distances are
+	computed for blocks of regions with about blockPairs distances at
+	once and summed in the order of the regions, so that the values are
+	the same as adding them one by one. Returns the arrays minD, nr and
+	sr, and whether any distance of each region is positive; if not,
+	its sr is an integer.
 	'''
-	print(sep.join(map(str,c)), file=o);
-
-def calc_crowdedness(focus, before, after):
-	'''calculate the following crowdness parameters
-	1. the distance from the closest region, -1 if no regions within
-	the considered window.
-	2. number of regions within the considered window.
-	3. the weighted sum of nearby regions. Now simply reciprocals of
-	distances, in future, kernel-smoother-like weights can be used.
-	before and after are arrays of regions before and after the focus
-	region in coordinates
+	n=len(starts);
+	idx=np.arange(n);
+	first=np.searchsorted(starts, ends + afterDist, side='left');
+	lastAfter=np.maximum.accumulate(np.maximum(first, idx+1)); # exclusive
+	nAfter=lastAfter - idx - 1;
+	reset=np.ones(n, dtype=bool);
+	reset[1:]=lastAfter[:-1] == idx[1:];
+	sessionStart=np.maximum.accumulate(np.where(reset, idx, 0));
+	# a region before the focus must start after this, since it ends
+	# at most maxLen after its start
+	maxLen=max(0, int((ends - starts).max())) if n > 0 else 0;
+	lo=np.maximum(sessionStart,
+			np.searchsorted(starts, starts - beforeDist - maxLen, side='right'));
+	minD=np.full(n, -1, dtype=np.int64);
+	nr=np.zeros(n, dtype=np.int64);
+	sr=np.zeros(n);
+	anyPos=np.zeros(n, dtype=bool);
+	big=np.iinfo(np.int64).max;
+	cumPairs=np.cumsum(idx - lo + nAfter);
+	f0=0;
+	while f0 < n:
+		f1=int(np.searchsorted(cumPairs, cumPairs[f0] + blockPairs, side='right'));
+		f1=min(n, max(f1, f0 + 1));
+		foci=idx[f0:f1];
+		# the pairs of focus and region before, in the order of regions
+		nCand=foci - lo[f0:f1];
+		pf=np.repeat(foci, nCand);
+		px=np.repeat(lo[f0:f1] - np.cumsum(nCand) + nCand, nCand) + np.arange(len(pf));
+		dBefore=starts[pf] - ends[px];
+		keep=dBefore < beforeDist;
+		pf, dBefore=pf[keep], dBefore[keep];
+		nBefore=np.bincount(pf - f0, minlength=f1 - f0);
+		# the pairs of focus and region after
+		nA=nAfter[f0:f1];
+		qf=np.repeat(foci, nA);
+		qj=np.repeat(foci + 1 - np.cumsum(nA) + nA, nA) + np.arange(len(qf));
+		dAfter=starts[qj] - ends[qf];
+		# minD
+		dB=np.full(f1 - f0, big);
+		hasB=nBefore > 0;
+		dB[hasB]=dBefore[np.cumsum(nBefore)[hasB] - 1];
+		dA=np.full(f1 - f0, big);
+		hasA=nA > 0;
+		dA[hasA]=starts[foci[hasA] + 1] - ends[foci[hasA]];
+		d=np.minimum(dB, dA);
+		minD[f0:f1]=np.where(d == big, -1, d);
+		# the rank of each distance for its focus: before, then after
+		counts=nBefore + nA;
+		nr[f0:f1]=counts;
+		rank=np.concatenate((np.arange(len(pf)) - np.repeat(np.cumsum(nBefore) - nBefore, nBefore),
+			np.repeat(nBefore - np.cumsum(nA) + nA, nA) + np.arange(len(qf))));
+		focus=np.concatenate((pf, qf)) - f0;
+		dist=np.concatenate((dBefore, dAfter));
+		pos=dist > 0;
+		w=np.ones(len(dist));
+		w[pos]=1.0/dist[pos];
+		anyPos[f0:f1]=np.bincount(focus, weights=pos, minlength=f1 - f0) > 0;
+		# add up the t-th distances of all the foci having them, for t
+		# from 0: with the foci sorted by decreasing counts, these are
+		# the first m[t] foci, and their t-th distances are put together
+		order=np.argsort(-counts, kind='stable');
+		orderRank=np.empty(f1 - f0, dtype=np.int64);
+		orderRank[order]=np.arange(f1 - f0);
+		m=np.bincount(counts, minlength=int(counts.max()) + 1 if len(counts) > 0 else 1);
+		m=len(counts) - np.cumsum(m)[:-1]; # the foci with counts > t
+		tStart=np.cumsum(m) - m;
+		byT=np.empty(len(w));
+		byT[tStart[rank] + orderRank[focus]]=w;
+		acc=np.zeros(f1 - f0);
+		for t in range(len(m)):
+			acc[:m[t]]+=byT[tStart[t]:tStart[t] + m[t]];
+		sr[f0 + order]=acc;
+		f0=f1;
+	return((minD, nr, sr, anyPos));
+
+def write_chrom(chrom, starts, ends, names, blockSize=200000):
+	'''calculate and output the crowdedness parameters of the regions
+	of one chromosome, formatting blockSize regions at a time
 	'''
-	dist=None;
-	if len(before) > 0:
-		dist = focus[1] - before[len(before)-1][2]; # start - end
-	if len(after) > 0:
-		tmp = after[0][1] - focus[2];
-		if dist is None or tmp < dist:
-			dist = tmp;
-	if dist is None: dist='-1'; # no nearby regions
-	nr = len(before) + len(after);
-	ws = sum([1.0/d if d > 0 else 1 for d in [ focus[1] - r[2] for r in before] ] +
-			[1.0/d if d > 0 else 1 for d in [ r[1] - focus[2] for r in after] ]);
-	return( focus + [dist, nr, ws]); # append the data
-
-def shift_focus(focus, before, after):
+	minD, nr, sr, anyPos=crowdedness(starts, ends);
+	# each distinct sum is formatted once; the sum of reciprocals is
+	# an integer when no distance is positive
+	values, inv=np.unique(sr, return_inverse=True);
+	srStr=np.array([str(x) for x in values.tolist()], dtype=object)[inv];
+	srStr[~anyPos]=nr[~anyPos].astype(str);
+	fmt=sep.join(["%s", "%d", "%d", "%s", "%d", "%d", "%s"]) + "\n";
+	for a in range(0, len(starts), blockSize):
+		b=min(len(starts), a + blockSize);
+		o.write("".join(map(fmt.__mod__, zip(repeat(chrom), starts[a:b].tolist(),
+			ends[a:b].tolist(), names[a:b], minD[a:b].tolist(), nr[a:b].tolist(),
+			srStr[a:b].tolist()))));
+
+def parse_lines(lines):
+	'''split a block of lines one by one and return the lists of
+	chromosomes, starts, ends and names, skipping lines whose start is
+	not a number and stopping at lines with less than 4 fields
 	'''
-	shift focus to next region, and clean up the 'before stack'
+	rows=[l.rstrip().split(sep, 4) for l in lines];
+	for r in rows:
+		if len(r) < 4:
+			warn("Less than 4 fields found on " + sep.join(r));
+			sys.exit(1);
+	isNum=[r[1].isdigit() for r in rows];
+	if not all(isNum):
+		for r, ok in zip(rows, isNum):
+			if not ok: warn(f"This '{r[1]}' is not number for start");
+		rows=[r for r, ok in zip(rows, isNum) if ok];
+	return(([r[0] for r in rows], [int(r[1]) for r in rows],
+		[int(r[2]) for r in rows], [r[3] for r in rows]));
+
+def parse_block(lines):
+	'''parse a block of lines with pandas and return the arrays of
+	chromosomes, starts, ends and names, or None if the block has lines
+	that parse_lines() must handle, such as short lines or headers
 	'''
-	before.append(focus); # add current focus to before regions
-	if len(after) < 1: return (None,[],[]); # no more focus
-	focus=after[0];
-	after=after[1:];
-	before=list(filter(lambda x:focus[1]-x[2]<beforeDist,
-			before)); # remove out-of-range before-regions
-	return (focus, before, after);
-
-def finish_left_regions(focus, before, after):
-	'''calculate crowdness for current focus and all regions in
-	the 'after' stack
+	try:
+		# a separator of several characters is a regular expression here
+		d=pd.read_csv(io.StringIO("".join(lines)), header=None,
+				sep=sep if len(sep) == 1 else re.escape(sep),
+				usecols=[0,1,2,3], dtype={0: str, 1: np.int64, 2: np.int64, 3: str},
+				na_filter=False, quoting=csv.QUOTE_NONE, skip_blank_lines=False,
+				engine='c' if len(sep) == 1 else 'python');
+	except (ValueError, pd.errors.ParserError):
+		return(None);
+	if len(d) != len(lines) or (d[3] == '').any() or (d[1] < 0).any():
+		return(None);
+	return((d[0].to_numpy(), d[1].to_numpy(), d[2].to_numpy(), d[3].to_numpy()));
+
+def read_regions(fh, blockSize=1000000):
+	'''read the regions of a bed file sorted by coordinates, in blocks
+	of lines, and yield (chrom, starts, ends, names) for each chromosome
 	'''
-	res=[];
-	tmp=calc_crowdedness(focus, before, after);
-	output(tmp);
-	res.append(tmp);
-	while len(after) > 0:
-		focus, before, after = shift_focus(focus, before, after);
-		tmp=calc_crowdedness(focus, before, after);
-		output(tmp);
-		res.append(tmp);
-	return(res);
+	lastChr=None;
+	lastStart=None;
+	analyzedChroms=set();
+	parts=[];
+	def regions():
+		return((lastChr, np.concatenate([x[0] for x in parts]),
+			np.concatenate([x[1] for x in parts]),
+			np.concatenate([x[2] for x in parts])));
+	while True:
+		lines=list(islice(fh, blockSize));
+		if not lines: break;
+		block=parse_block(lines);
+		if block is None:
+			block=[np.array(x, dtype=object if k in (0, 3) else np.int64)
+				for k, x in enumerate(parse_lines(lines))];
+		chroms, starts, ends, names=block;
+		bounds=np.concatenate(([0], np.flatnonzero(chroms[1:] != chroms[:-1]) + 1,
+			[len(chroms)]));
+		for a, b in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+			if a == b: continue;
+			chrom=chroms[a];
+			if lastChr is not None and lastChr != chrom: # new chromosome
+				if chrom in analyzedChroms:
+					sys.exit(f"chromosome '{chrom}' appears in multiple blocks. file not sorted")
+				analyzedChroms.add(chrom);
+				yield(regions());
+				parts=[];
+				lastStart=None;
+			if (np.diff(starts[a:b]) < 0).any() or (lastStart is not None and starts[a] < lastStart):
+				sys.exit("The input file is not coordinate sorted");
+			parts.append((starts[a:b], ends[a:b], names[a:b]));
+			lastChr=chrom;
+			lastStart=starts[b-1];
+	if parts:
+		yield(regions());
 
 desc='''
 Given a list of genomic regions, this program calculates the
@@ -119,71 +261,14 @@ beforeDist=afterDist=winLen/2.0;
 sep=args.sep;
 
 i=open(args.inFile, "r");
-o=open(args.outFile, "w");
-output(['chr','start','end','name','minD','nr','sr']);
-
-lastStart=None;
-lastChr=None;
-analyzedChroms=[];
-focus=None;
-beforeRegions=[];
-afterRegions=[];
-counter=0;
-
-for r in i:
-	r = r.rstrip().split(sep);
-	if len(r) < 4:
-		warn("Less than 4 fields found on " + sep.join(r));
-		sys.exit(1);
-	chrom, start, end, name = r[:4];
-	if not start.isdigit():
-		warn(f"This '{start}' is not number for start");
-		continue;
-	counter += 1;
-	if counter % 2000 == 0:
-		warn(f"{counter} lines have been processed");
-	if lastChr is not None and lastChr != chrom: # new chromosome
-		if chrom in analyzedChroms:
-			sys.exit(f"chromosome '{chrom}' appears in multiple blocks. file not sorted")
-		analyzedChroms.append(chrom);
-		# This is new chromosome and we need finish all the remaining
-		# regions
-		resSet=finish_left_regions(focus, beforeRegions, afterRegions);
-		# reset all regions
-		focus=None;
-		beforeRegions=[];
-		afterRegions=[];
-	
-	start = int(start);
-	end = int(end);
-	if focus is None: # no focused region yet
-		focus=[chrom,start,end,name];
-		lastChr=chrom;
-		lastStart=start;
-		continue;
-	# there is focus, check the distance to it
-	if lastChr == chrom and start < lastStart:
-		sys.exit("The input file is not coordinate sorted");
-	## the new region is out of range, run calculation for current
-	## focused region and shift to next region until the new region
-	## is within distance
-	while start-focus[2] >= afterDist:
-		res=calc_crowdedness(focus, beforeRegions, afterRegions);
-		output(res);
-		focus, beforeRegions, afterRegions = shift_focus(focus,
-				beforeRegions, afterRegions);
-		if focus is None: # no more regions in after
-			break
-	
-	if focus is None:
-		focus = [chrom,start,end,name];
-	else: ## otherwise append this region to afterRegions stack only
-		afterRegions.append([chrom,start,end,name]);
-	lastChr=chrom;
-	lastStart=start;
-
-# finish the remaining regions
-if focus is not None: finish_left_regions(focus, beforeRegions, afterRegions);
+o=args.outFile;
+if type(o) is str:
+	o=open(o, "w");
+o.write(sep.join(['chr','start','end','name','minD','nr','sr']) + "\n");
+
+for chrom, starts, ends, names in read_regions(i):
+	write_chrom(chrom, starts, ends, names);
+	warn(f"{len(starts)} regions on {chrom} have been processed");
 
 i.close();
 o.close();
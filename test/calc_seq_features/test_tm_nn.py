@@ -0,0 +1,64 @@
+#!/bin/env python
+
+# check that the built-in nearest-neighbor Tm (--tm-engine nn) agrees
+# with the reference Tm in the second column of tm_ref_seqs.txt, and
+# with melting.temp when melting is installed.
+# Run with --update to replace the reference column with melting's Tm.
+
+import sys;
+import os;
+import subprocess;
+
+TOLERANCE = 0.5; # in degrees
+
+here = os.path.dirname(os.path.abspath(__file__));
+prog = os.path.join(here, "..", "..", "calc_seq_features.py");
+seqFile = os.path.join(here, "tm_ref_seqs.txt");
+
+def run_tm(engine, *opts):
+	''' run calc_seq_features.py and return the Tm column '''
+	out = subprocess.run([sys.executable, prog, seqFile, "--no-ncpg", "--no-gc",
+		"--tm-engine", engine] + list(opts),
+		check=True, capture_output=True, text=True).stdout;
+	return([float(l.split("\t")[2]) for l in out.splitlines()[1:]]);
+
+def check(name, seqs, ref, tm):
+	''' report the sequences differing by more than TOLERANCE '''
+	diffs = [abs(a - b) for a, b in zip(ref, tm)];
+	for s, a, b, d in zip(seqs, ref, tm, diffs):
+		if d > TOLERANCE:
+			print(f"{s}\t{name}={a}\tnn={b}", file=sys.stderr);
+	print(f"{len(seqs)} sequences, max difference from {name} {max(diffs):.3f}", file=sys.stderr);
+	return(len(tm) == len(seqs) and max(diffs) <= TOLERANCE);
+
+try:
+	import melting;
+except ImportError:
+	melting = None;
+
+rows = [l.rstrip("\n").split("\t") for l in open(seqFile)];
+seqs = [r[0] for r in rows];
+
+if "--update" in sys.argv[1:]:
+	if melting is None:
+		sys.exit("melting is needed for --update");
+	ref = run_tm("melting", "--tm-cache-size", "0");
+	with open(seqFile, "w") as f:
+		f.write("".join(f"{s}\t{t}\n" for s, t in zip(seqs, ref)));
+	print(f"Reference Tm of {len(seqs)} sequences updated from melting", file=sys.stderr);
+	sys.exit(0);
+
+ref = [float(r[1]) for r in rows];
+nn = run_tm("nn");
+nnBatch = run_tm("nn", "--batch");
+if nn != nnBatch:
+	sys.exit("Tm from --batch differs from the serial run");
+ok = check("reference", seqs, ref, nn);
+if melting is not None:
+	ok = check("melting", seqs, run_tm("melting", "--tm-cache-size", "0"), nn) and ok;
+else:
+	print("[Warning] melting is not installed; compared with the reference column only", file=sys.stderr);
+if not ok:
+	sys.exit(f"Tm differs by more than {TOLERANCE}");
+print("Test passed", file=sys.stderr);
+sys.exit(0);
@@ -0,0 +1,37 @@
+#!/bin/env python
+
+# check that get_CpG_pos_in_region.py gives the same output with and
+# without --batch, for regions which overlap, are adjacent, or run
+# past the chromosome ends
+
+import sys;
+import os;
+import subprocess;
+
+TIMEOUT = 60; # seconds, as a failing run may hang
+
+here = os.path.dirname(os.path.abspath(__file__));
+prog = os.path.join(here, "..", "..", "get_CpG_pos_in_region.py");
+bedFile = os.path.join(here, "regions.bed");
+genome = os.path.join(here, "genome.2bit");
+
+def run(*opts):
+	''' run get_CpG_pos_in_region.py and return its output '''
+	return(subprocess.run([sys.executable, prog, bedFile, genome] + list(opts),
+		check=True, capture_output=True, text=True, timeout=TIMEOUT).stdout);
+
+failed = 0;
+for opts in [[], ["-c"], ["--motifs", "CG,CHG,CHH"], ["--motifs", "CG,CHG", "-c"]]:
+	for more in [[], ["--chunk-size", "7", "--cpus", "2"]]:
+		ref = run(*(opts + more));
+		res = run(*(opts + more + ["--batch"]));
+		name = " ".join(opts + more) or "default";
+		if res != ref:
+			print(f"--batch differs with options: {name}", file=sys.stderr);
+			failed += 1;
+		else:
+			print(f"OK: {name}, {len(ref.splitlines())} lines", file=sys.stderr);
+if failed:
+	sys.exit(f"{failed} checks failed");
+print("Test passed", file=sys.stderr);
+sys.exit(0);
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import struct
+import argparse as ap
+from multiprocessing import shared_memory
+import numpy as np
+
+# 2bit codes: T=0, C=1, A=2, G=3, 4 bases per byte, first base in the
+# highest bits
+BASES = np.frombuffer(b"TCAG", dtype=np.uint8)
+BYTE_TO_BASES = BASES[(np.arange(256)[:, None] >> np.array([6, 4, 2, 0])) & 3]
+
+class TwoBit:
+    '''
+    A reader for UCSC .2bit files. The file is memory-mapped once, and
+    only the bytes of the requested region are decoded, so that opening
+    the reader once per process is cheap and the system page cache is
+    shared between processes.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.buf = np.memmap(path, dtype=np.uint8, mode='r')
+        sig = struct.unpack_from("<I", self.buf, 0)[0]
+        if sig == 0x1A412743:
+            self.endian = "<"
+        elif sig == 0x4327411A:
+            self.endian = ">"
+        else:
+            raise ValueError(f"'{path}' is not a 2bit file")
+        version, count = struct.unpack_from(self.endian + "II", self.buf, 4)
+        if version not in (0, 1):
+            raise ValueError(f"'{path}' has unknown 2bit version {version}")
+        offFmt = self.endian + ("Q" if version == 1 else "I")
+        offSize = struct.calcsize(offFmt)
+        self.offsets = {}
+        pos = 16
+        for _ in range(count):
+            n = int(self.buf[pos])
+            name = bytes(self.buf[pos+1:pos+1+n]).decode()
+            pos += 1 + n
+            self.offsets[name] = struct.unpack_from(offFmt, self.buf, pos)[0]
+            pos += offSize
+        self.headers = {}
+
+    def _array(self, pos, n):
+        return np.frombuffer(self.buf, dtype=self.endian + "u4", count=n,
+                offset=pos).astype(np.int64)
+
+    def header(self, chrom):
+        '''
+        return (size, nStarts, nEnds, maskStarts, maskEnds, dnaOffset)
+        of a sequence, or None if the sequence is not in the file
+        '''
+        if chrom in self.headers:
+            return self.headers[chrom]
+        if chrom not in self.offsets:
+            return None
+        pos = self.offsets[chrom]
+        size, nCount = struct.unpack_from(self.endian + "II", self.buf, pos)
+        pos += 8
+        nStarts = self._array(pos, nCount)
+        nEnds = nStarts + self._array(pos + 4*nCount, nCount)
+        pos += 8*nCount
+        mCount = struct.unpack_from(self.endian + "I", self.buf, pos)[0]
+        pos += 4
+        mStarts = self._array(pos, mCount)
+        mEnds = mStarts + self._array(pos + 4*mCount, mCount)
+        pos += 8*mCount + 4 # reserved field
+        self.headers[chrom] = (size, nStarts, nEnds, mStarts, mEnds, pos)
+        return self.headers[chrom]
+
+    def size(self, chrom):
+        '''
+        return the length of a sequence, or None if it's not in the file
+        '''
+        h = self.header(chrom)
+        return None if h is None else h[0]
+
+    def names(self):
+        '''
+        return the sequence names in file order
+        '''
+        return list(self.offsets)
+
+    def codes(self, chrom, start, end):
+        '''
+        return the ASCII codes (uint8 array) of the sequence [start, end),
+        with N-blocks as 'N' and masked blocks in lowercase, or None if
+        the sequence is not in the file or the region is out of range
+        '''
+        h = self.header(chrom)
+        if h is None:
+            return None
+        size, nStarts, nEnds, mStarts, mEnds, dnaOffset = h
+        if start < 0 or end > size or start > end:
+            return None
+        packed = self.buf[dnaOffset + start//4 : dnaOffset + (end+3)//4]
+        seq = BYTE_TO_BASES[packed].ravel()[start % 4 : start % 4 + end - start]
+        for s, e in self._overlaps(nStarts, nEnds, start, end):
+            seq[s:e] = ord('N')
+        for s, e in self._overlaps(mStarts, mEnds, start, end):
+            seq[s:e] |= 0x20 # lowercase
+        return seq
+
+    def seq(self, chrom, start, end):
+        '''
+        return the sequence [start, end) as a string, the same as
+        'twoBitToFa -seq=chrom -start=start -end=end', or None
+        '''
+        s = self.codes(chrom, start, end)
+        return None if s is None else s.tobytes().decode()
+
+    @staticmethod
+    def _overlaps(blockStarts, blockEnds, start, end):
+        '''
+        yield the parts of the blocks within [start, end), relative to
+        start
+        '''
+        i0 = np.searchsorted(blockEnds, start, side='right')
+        i1 = np.searchsorted(blockStarts, end, side='left')
+        for s, e in zip(blockStarts[i0:i1].tolist(), blockEnds[i0:i1].tolist()):
+            yield (max(s, start) - start, min(e, end) - start)
+
+
+class SharedGenome:
+    '''
+    Sequences decoded once from a .2bit file into shared memory blocks,
+    one per chromosome, with the same size(), codes() and seq() methods
+    as TwoBit. Created in the main process before the workers start;
+    each worker process attaches to the blocks by name, read-only, on
+    first use, so the decoded genome is in memory only once for any
+    number of workers. The creator must call close() to free the blocks.
+    '''
+    def __init__(self, twobitFile, chroms, step=10000000):
+        genome = TwoBit(twobitFile)
+        self.owner = os.getpid()
+        self.blocks = {}  # chrom => (shared memory name, size)
+        self.shms = {}
+        self.views = {}
+        self.pid = self.owner
+        for chrom in chroms:
+            size = genome.size(chrom)
+            if size is None or chrom in self.blocks:
+                continue
+            shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+            view = np.ndarray(size, dtype=np.uint8, buffer=shm.buf)
+            for start in range(0, size, step): # decode without a full copy
+                end = min(size, start + step)
+                view[start:end] = genome.codes(chrom, start, end)
+            view.flags.writeable = False
+            self.blocks[chrom] = (shm.name, size)
+            self.shms[chrom] = shm
+            self.views[chrom] = view
+
+    def _view(self, chrom):
+        if self.pid != os.getpid(): # a new worker: attach to the blocks again
+            self.pid = os.getpid()
+            self.shms = {}
+            self.views = {}
+        if chrom not in self.views:
+            shm = shared_memory.SharedMemory(name=self.blocks[chrom][0])
+            view = np.ndarray(self.blocks[chrom][1], dtype=np.uint8, buffer=shm.buf)
+            view.flags.writeable = False
+            self.shms[chrom] = shm
+            self.views[chrom] = view
+        return self.views[chrom]
+
+    def size(self, chrom):
+        '''
+        return the length of a sequence, or None if it's not shared
+        '''
+        return self.blocks[chrom][1] if chrom in self.blocks else None
+
+    def names(self):
+        return list(self.blocks)
+
+    def codes(self, chrom, start, end):
+        '''
+        return the ASCII codes of the sequence [start, end) as a read-only
+        view of the shared block, or None, the same as TwoBit.codes()
+        '''
+        size = self.size(chrom)
+        if size is None or start < 0 or end > size or start > end:
+            return None
+        return self._view(chrom)[start:end]
+
+    def seq(self, chrom, start, end):
+        s = self.codes(chrom, start, end)
+        return None if s is None else s.tobytes().decode()
+
+    def close(self):
+        '''
+        detach from the blocks, and free them if called by the creator
+        '''
+        self.views = {}
+        for shm in self.shms.values():
+            shm.close()
+            if os.getpid() == self.owner:
+                shm.unlink()
+        self.shms = {}
+
+
+if __name__ == "__main__":
+
+    desc='''
+    This program extracts sequences from a .2bit file in fasta format,
+    like twoBitToFa, without the need of the UCSC binary.
+    '''
+
+    authorInfo='''
+    Author: Zhenguo Zhang
+    Email: zhangz.sci@gmail.com
+    '''
+
+    optParser=ap.ArgumentParser(
+            description=desc,
+            formatter_class=ap.RawTextHelpFormatter,
+            epilog=authorInfo)
+
+    optParser.add_argument("twobitFile",
+            help="the .2bit file from which sequences are extracted")
+
+    optParser.add_argument("regions", nargs="+",
+            help="regions in the format chrom or chrom:start-end (0-based, right open)")
+
+    args=optParser.parse_args()
+    genome=TwoBit(args.twobitFile)
+    for r in args.regions:
+        chrom, _, span = r.partition(":")
+        if span:
+            start, end = (int(x) for x in span.split("-"))
+        else:
+            start, end = 0, genome.size(chrom) or 0
+        seq = genome.seq(chrom, start, end)
+        if seq is None:
+            print(f"Cannot get sequence for [{r}]", file=sys.stderr)
+            continue
+        print(f">{r}" if span else f">{chrom}")
+        for i in range(0, len(seq), 50):
+            print(seq[i:i+50])
+
+    sys.exit(0)